@@ -2,12 +2,13 @@
 Fermer Agent Package
 """
 
-from .graph import fermer_graph, process_message
+from .graph import fermer_graph, process_message, stream_message
 from .tools import get_schedule_by_club, search_knowledge_base, get_payment_link
 
 __all__ = [
     "fermer_graph",
     "process_message",
+    "stream_message",
     "get_schedule_by_club",
     "search_knowledge_base",
     "get_payment_link",
@@ -9,17 +9,22 @@ Fermer Respond Agent - LangGraph Migration
         → If escalation → Notify Managers
 """
 
-from typing import TypedDict, Annotated, Literal, Optional
+from typing import TypedDict, Annotated, AsyncIterator, Literal, Optional
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, message_chunk_to_message
 from langchain_openai import ChatOpenAI
-from pydantic import BaseModel, Field
-import json
+from pydantic import AliasChoices, BaseModel, Field, ValidationError, field_validator
+import asyncio
+import httpx
+import logging
+import orjson
+import os
 import re
 from datetime import datetime
+from types import MappingProxyType
 
 from tools import (
     # Core tools
@@ -34,11 +39,12 @@ from tools import (
     get_clan_battle_info,
     get_workouts_descriptions,
     get_membership_info,
+    get_docs_bundle,
     # Other tools
     analyze_image,
     update_user_profile,
 )
-from prompts import get_system_prompt, get_user_prompt
+from prompts import format_history, get_system_prompt, get_user_prompt
 from integrations import (
     fetch_fermer_data,
     log_message_to_db,
@@ -49,18 +55,47 @@ from integrations import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+
 # ============== STATE DEFINITION ==============
 
 class EscalationInfo(BaseModel):
     """Structured output for escalation decisions"""
-    needed: bool = Field(description="Whether human escalation is needed")
-    reason: str = Field(default="", description="Reason for escalation if needed")
+    needed: bool = Field(default=False, description="Whether human escalation is needed")
+    reason: Optional[str] = Field(default="", description="Reason for escalation if needed")
+    
+    @field_validator("needed", mode="before")
+    @classmethod
+    def _null_needed(cls, value):
+        # The model sometimes emits "needed": null
+        return False if value is None else value
+    
+    @field_validator("reason", mode="before")
+    @classmethod
+    def _stringify_reason(cls, value):
+        # Numbers, lists...: keep the reason as text rather than fail the parse
+        return value if value is None or isinstance(value, str) else str(value)
 
 
 class AgentResponse(BaseModel):
     """Structured output from AI agent"""
-    response_text: str = Field(description="Response message to customer in Russian")
-    escalation: EscalationInfo = Field(description="Escalation information")
+    response_text: Optional[str] = Field(
+        default=None,
+        # System prompt asks for "response"; accept the field name as well
+        validation_alias=AliasChoices("response", "response_text"),
+        description="Response message to customer in Russian",
+    )
+    escalation: EscalationInfo = Field(
+        default_factory=EscalationInfo,
+        description="Escalation information",
+    )
+    
+    @field_validator("escalation", mode="before")
+    @classmethod
+    def _non_dict_escalation(cls, value):
+        # null, strings, lists...: no escalation info rather than a failed parse
+        return value if isinstance(value, (dict, EscalationInfo)) else EscalationInfo()
 
 
 class FermerState(TypedDict):
@@ -87,7 +122,7 @@ class FermerState(TypedDict):
     query_id: Optional[str]
     user_data: Optional[dict]
     user_profile: Optional[dict]
-    messages_history: list[str]
+    history_text: str  # last dialog messages, rendered once per fetch
     training_data: Optional[dict]
     triggers: dict  # first_training, no_activity, finish_program, payment
     club_id: Optional[str]
@@ -115,23 +150,220 @@ class FermerState(TypedDict):
 
 # ============== CLUB MAPPINGS ==============
 
-CLUB_MANAGERS = {
-    "6351ace4d61faf000b2febc8": 8800966,   # Нурлы Орда → Камиля
-    "65e9e70cbd4814536c5e27e9": 10738998,  # Colibri → Рысалды
-    "6788b54527af6c00ab78c66a": 11613982,  # Europe City → Дана
-    "683704d8c85fb0a6b1f5a8ca": 12536974,  # Villa → Салтанат
-    "67d7c4cc8b5b3112cb0bcd44": 12234034,  # Promenade → Аида
-    "68a45233d9ba5a6ba953e5f0": 12885486,  # 4you → Мадина
-}
-
-CLUB_TG_CHATS = {
-    "65e9e70cbd4814536c5e27e9": -4900775642,     # Colibri
-    "6351ace4d61faf000b2febc8": -1002535386890,  # Nurly Orda
-    "683704d8c85fb0a6b1f5a8ca": -1002648405729,  # Villa
-    "67d7c4cc8b5b3112cb0bcd44": -1002765678928,  # Promenade
-    "6788b54527af6c00ab78c66a": -1002664385193,  # Europe City
-    "68a45233d9ba5a6ba953e5f0": -1003568350790,  # 4YOU
-}
+# club_id → (manager Telegram ID, club Telegram chat)
+CLUB_ROUTING = MappingProxyType({
+    "6351ace4d61faf000b2febc8": (8800966, -1002535386890),   # Нурлы Орда → Камиля
+    "65e9e70cbd4814536c5e27e9": (10738998, -4900775642),     # Colibri → Рысалды
+    "6788b54527af6c00ab78c66a": (11613982, -1002664385193),  # Europe City → Дана
+    "683704d8c85fb0a6b1f5a8ca": (12536974, -1002648405729),  # Villa → Салтанат
+    "67d7c4cc8b5b3112cb0bcd44": (12234034, -1002765678928),  # Promenade → Аида
+    "68a45233d9ba5a6ba953e5f0": (12885486, -1003568350790),  # 4you → Мадина
+})
+
+# Default managers group for escalations from clubs without a routing entry
+DEFAULT_ESCALATION_TG_CHAT = -1003234914487
+
+# Telegram escalation notification (HTML parse mode), filled via format_map
+ESCALATION_TG_TEMPLATE = (
+    "🚨 <b>Эскалация</b>\n\n"
+    "👤 Клиент: {user_name}\n"
+    "📱 Chat ID: {sender_id}\n"
+    "🏢 Клуб: {club_name}\n\n"
+    "❗ Причина: {reason}\n\n"
+    "💬 <b>Последнее сообщение:</b>\n"
+    "USER: {message}\n\n"
+    "🤖 <b>Ответ AI:</b>\n"
+    "{ai_response}"
+)
+ESCALATION_TG_AI_RESPONSE_LENGTH = 500
+
+
+# Pre-filter: messages that never need an answer: bot commands, acknowledgements, dots
+_BLOCKLIST_RE = re.compile(r"^(/start|ok|👍|\.+)$", re.IGNORECASE)
+SUPPORTED_SOURCES = frozenset({"whatsapp", "telegram"})
+MIN_MESSAGE_LENGTH = 2
+
+
+# Agent output JSON, possibly wrapped in a markdown fence
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# ReAct context limits: messages re-sent per iteration and earlier tool output size
+MAX_AGENT_MESSAGES = 20
+AGENT_MESSAGES_TAIL = 12
+TOOL_OUTPUT_MAX_LENGTH = 2000
+TOOL_OUTPUT_TRIM_LENGTH = 1500
+
+# Responses shorter than this are sent verbatim, without the humanizer LLM
+HUMANIZER_MIN_LENGTH = 80
+
+# Humanizer tone by hour of day (index = hour)
+_NIGHT = "ночь - лаконичный тон"
+_MORNING = "утро - энергичный тон"
+_DAY = "день - деловой тон"
+_EVENING = "вечер - спокойный тон"
+TONE_BY_HOUR = (
+    (_NIGHT,) * 6       # 00-05
+    + (_MORNING,) * 5   # 06-10
+    + (_DAY,) * 6       # 11-16
+    + (_EVENING,) * 6   # 17-22
+    + (_NIGHT,)         # 23
+)
+
+# Static humanizer instructions — identical across requests so the provider
+# can serve them from its prompt cache; per-request data goes in the user message
+HUMANIZER_SYSTEM_MESSAGE = SystemMessage(content="""Ты — Humanizer Agent. Сделай AI-ответ живым и естественным.
+ПРАВИЛА: сохрани ВСЮ информацию (цены, даты, имена); тон по времени суток; обращение на "Вы"; без новой информации; макс 600 символов, 1-3 коротких абзаца.
+ЗАПРЕЩЕНО: "Уважаемый", "С уважением", канцеляризмы.
+Верни только гуманизированную версию.""")
+
+# Checkpointing: "memory" keeps state for /graph/* debug endpoints, "none" disables it.
+# Each request is self-contained, so state is only persisted once the run exits.
+CHECKPOINTER = os.getenv("FERMER_CHECKPOINTER", "memory")
+CHECKPOINT_DURABILITY = "exit"
+
+
+# ============== TRIGGERS ==============
+
+# GraphQL trigger flag → trigger_type, in priority order (first match wins)
+TRIGGER_PRIORITY = (
+    ("firstTraining", "first_training"),
+    ("noActivity", "no_activity"),
+    ("finishProgram", "finish_program"),
+    ("payment", "payment"),
+)
+
+
+# ============== AGENT TOOLS & LLMS ==============
+
+# All tools matching n8n workflow
+AGENT_TOOLS = [
+    # Core tools
+    get_schedule_by_club,
+    search_knowledge_base,
+    get_payment_link,
+    # Google Docs tools (from n8n)
+    get_general_info,
+    get_social_features,
+    get_app_functionality,
+    get_workout_info,
+    get_clan_battle_info,
+    get_workouts_descriptions,
+    get_membership_info,
+    get_docs_bundle,
+    # Other tools
+    analyze_image,
+    update_user_profile,
+]
+# Tool name → bound ainvoke, resolved once at import
+TOOL_DISPATCH = MappingProxyType({tool.name: tool.ainvoke for tool in AGENT_TOOLS})
+
+# Lazy initialization: bind_tools serializes every tool schema, so do it once
+_agent_llm = None
+_humanizer_llm = None
+_openai_http_client = None
+
+
+def _get_openai_http_client() -> httpx.AsyncClient:
+    """
+    Shared HTTP/2 connection pool for both LLMs, so agent and humanizer calls
+    reuse the same keep-alive connections to api.openai.com.
+    """
+    global _openai_http_client
+    if _openai_http_client is None:
+        _openai_http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=60.0,
+        )
+    return _openai_http_client
+
+
+def _get_agent_llm():
+    """Lazy initialization of the agent LLM with tools bound."""
+    global _agent_llm
+    if _agent_llm is None:
+        _agent_llm = ChatOpenAI(
+            model="gpt-4o",
+            temperature=0.7,
+            http_async_client=_get_openai_http_client(),
+        ).bind_tools(AGENT_TOOLS)
+    return _agent_llm
+
+
+def _get_humanizer_llm():
+    """Lazy initialization of the humanizer LLM."""
+    global _humanizer_llm
+    if _humanizer_llm is None:
+        # 600 characters of Russian fit well within 400 tokens
+        _humanizer_llm = ChatOpenAI(
+            model="gpt-4o-mini",
+            temperature=0.8,
+            max_tokens=400,
+            http_async_client=_get_openai_http_client(),
+        )
+    return _humanizer_llm
+
+
+# ============== BACKGROUND TASKS ==============
+
+# Strong references to fire-and-forget tasks so they aren't garbage-collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _run_in_background(coro) -> asyncio.Task:
+    """Schedule a fire-and-forget coroutine; failures are logged, not raised."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed: %s", task.exception())
+
+
+# ============== MESSAGE LOG QUEUE ==============
+
+# AI messages are logged to the DB by a single worker: it drains up to
+# LOG_BATCH_SIZE queued items (waiting at most LOG_BATCH_WINDOW seconds for
+# more) and writes them together, so DB latency never reaches the graph.
+LOG_BATCH_SIZE = 20
+LOG_BATCH_WINDOW = 0.05
+
+_log_queue: Optional[asyncio.Queue] = None
+_log_worker_task: Optional[asyncio.Task] = None
+
+
+def _enqueue_message_log(**fields) -> None:
+    """Queue a log_message_to_db call; starts the worker on the running loop if needed."""
+    global _log_queue, _log_worker_task
+    
+    if _log_worker_task is None or _log_worker_task.done() \
+            or _log_worker_task.get_loop() is not asyncio.get_running_loop():
+        _log_queue = asyncio.Queue()
+        _log_worker_task = _run_in_background(_log_worker(_log_queue))
+    
+    _log_queue.put_nowait(fields)
+
+
+async def _log_worker(queue: asyncio.Queue) -> None:
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), LOG_BATCH_WINDOW))
+            except asyncio.TimeoutError:
+                break
+        
+        results = await asyncio.gather(
+            *(log_message_to_db(**item) for item in batch),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Failed to log message to DB: %s", result)
 
 
 # ============== NODE FUNCTIONS ==============
@@ -140,10 +372,20 @@ def extract_message_data(state: FermerState) -> dict:
     """
     Node 1: Extract and normalize message data from webhook.
     Equivalent to n8n "Extract Message Data" node.
+    
+    Also pre-filters non-conversational messages (empty bodies, stickers,
+    "ok"/👍, unsupported channels) so they end the run before any I/O.
     """
+    message = (state.get("message") or "").strip()
+    should_respond = (
+        len(message) >= MIN_MESSAGE_LENGTH
+        and not _BLOCKLIST_RE.match(message)
+        and state.get("source", "whatsapp") in SUPPORTED_SOURCES
+    )
+    
     return {
         "timestamp": state.get("timestamp") or datetime.now().isoformat(),
-        "should_respond": bool(state.get("message")),
+        "should_respond": should_respond,
     }
 
 
@@ -170,12 +412,9 @@ async def fetch_fermer_data_node(state: FermerState) -> dict:
         queries = fermer_data.get("queries", [])
         current_query = queries[-1] if queries else {}
         
-        # Build messages history
+        # Render the history window once here; prompt builds just interpolate it
         dialog = current_query.get("dialog", [])
-        messages_history = [
-            f"{msg.get('sender', '')} ({msg.get('created_at', '')}): {msg.get('text', '')}"
-            for msg in dialog
-        ]
+        history_text = format_history(dialog)
         
         # Extract training data from last auto message
         training_data = {}
@@ -191,17 +430,19 @@ async def fetch_fermer_data_node(state: FermerState) -> dict:
             "finishProgram": True,
         })
         
+        club_manager_tg, club_tg_chat = CLUB_ROUTING.get(club_id, (None, None))
+        
         return {
             "user_id": fermer_data.get("userId"),
             "query_id": current_query.get("id"),
             "user_data": user_data,
             "user_profile": user_profile,
-            "messages_history": messages_history,
+            "history_text": history_text,
             "training_data": training_data,
             "triggers": triggers,
             "club_id": club_id,
-            "club_manager_tg": CLUB_MANAGERS.get(club_id),
-            "club_tg_chat": CLUB_TG_CHATS.get(club_id),
+            "club_manager_tg": club_manager_tg,
+            "club_tg_chat": club_tg_chat,
         }
         
     except Exception as e:
@@ -216,18 +457,12 @@ def select_trigger_type(state: FermerState) -> dict:
     Node 3: Determine trigger type based on user state.
     Equivalent to n8n "Switch" node.
     """
-    triggers = state.get("triggers", {})
-    
-    if triggers.get("firstTraining"):
-        trigger_type = "first_training"
-    elif triggers.get("noActivity"):
-        trigger_type = "no_activity"
-    elif triggers.get("finishProgram"):
-        trigger_type = "finish_program"
-    elif triggers.get("payment"):
-        trigger_type = "payment"
-    else:
-        trigger_type = "default"
+    triggers = state.get("triggers") or {}
+    
+    trigger_type = next(
+        (trigger_type for key, trigger_type in TRIGGER_PRIORITY if triggers.get(key)),
+        "default",
+    )
     
     return {"trigger_type": trigger_type}
 
@@ -239,16 +474,12 @@ def build_prompts(state: FermerState) -> dict:
     """
     trigger_type = state["trigger_type"]
     
-    system_prompt = get_system_prompt(
-        trigger_type=trigger_type,
-        user_data=state.get("user_data", {}),
-        user_profile=state.get("user_profile", {}),
-    )
+    system_prompt = get_system_prompt(trigger_type)
     
     user_prompt = get_user_prompt(
         trigger_type=trigger_type,
         message=state["message"],
-        messages_history=state.get("messages_history", []),
+        history_text=state.get("history_text", ""),
         training_data=state.get("training_data", {}),
         user_data=state.get("user_data", {}),
     )
@@ -287,89 +518,35 @@ async def ai_agent_node(state: FermerState) -> dict:
     2. Iterates until the LLM produces a final response
     3. Parses the JSON output for escalation info
     """
-    # All tools matching n8n workflow
-    tools = [
-        # Core tools
-        get_schedule_by_club,
-        search_knowledge_base,
-        get_payment_link,
-        # Google Docs tools (from n8n)
-        get_general_info,
-        get_social_features,
-        get_app_functionality,
-        get_workout_info,
-        get_clan_battle_info,
-        get_workouts_descriptions,
-        get_membership_info,
-        # Other tools
-        analyze_image,
-        update_user_profile,
-    ]
-    tools_by_name = {tool.name: tool for tool in tools}
-
-    llm = ChatOpenAI(
-        model="gpt-4o",
-        temperature=0.7,
-    ).bind_tools(tools)
+    llm = _get_agent_llm()
 
     messages = list(state["messages"])
     max_iterations = 5  # Prevent infinite loops
 
     try:
         for _ in range(max_iterations):
-            # Call LLM
-            response = await llm.ainvoke(messages)
+            # Call LLM (streamed, so tokens reach stream_mode="messages" consumers)
+            response = await _astream_to_message(llm, _trim_agent_messages(messages))
             messages.append(response)
 
             # Check if LLM wants to call tools
             if response.tool_calls:
-                # Execute each tool call
-                for tool_call in response.tool_calls:
-                    tool_name = tool_call["name"]
-                    tool_args = tool_call["args"]
-
-                    if tool_name in tools_by_name:
-                        tool = tools_by_name[tool_name]
-                        # Execute the tool
-                        try:
-                            tool_result = await tool.ainvoke(tool_args)
-                        except Exception as e:
-                            tool_result = f"Error executing {tool_name}: {str(e)}"
-
-                        # Add tool result to messages
-                        messages.append(ToolMessage(
-                            content=str(tool_result),
-                            tool_call_id=tool_call["id"],
-                        ))
-                    else:
-                        messages.append(ToolMessage(
-                            content=f"Unknown tool: {tool_name}",
-                            tool_call_id=tool_call["id"],
-                        ))
+                # Tools are independent network/RAG calls — run them concurrently,
+                # results are appended in the original tool_calls order
+                tool_messages = await asyncio.gather(
+                    *(_execute_tool_call(tool_call) for tool_call in response.tool_calls)
+                )
+                messages.extend(tool_messages)
             else:
                 # No tool calls - LLM produced final response
                 break
 
         # Parse the final response for escalation info
         final_content = response.content
-        escalation_needed = False
-        escalation_reason = ""
-        response_text = final_content
-
-        # Try to parse as JSON (as specified in system prompt)
-        try:
-            # Extract JSON from response if wrapped in markdown
-            json_match = re.search(r'\{[\s\S]*\}', final_content)
-            if json_match:
-                parsed = json.loads(json_match.group())
-                response_text = parsed.get("response", parsed.get("response_text", final_content))
-                escalation_data = parsed.get("escalation", {})
-                if isinstance(escalation_data, dict):
-                    escalation_needed = escalation_data.get("needed", False)
-                    escalation_reason = escalation_data.get("reason", "")
-        except (json.JSONDecodeError, AttributeError):
-            # If not valid JSON, use the raw response
-            pass
+        parsed = _parse_agent_output(final_content)
+        response_text = parsed.response_text or final_content
+        escalation_needed = parsed.escalation.needed
+        escalation_reason = parsed.escalation.reason or ""
 
         return {
             "response_text": response_text,
@@ -385,6 +562,128 @@ async def ai_agent_node(state: FermerState) -> dict:
         }
 
 
+def _trim_agent_messages(messages: list) -> list:
+    """
+    Bound the context re-sent to the LLM on every ReAct iteration.
+    
+    - Tool outputs from earlier iterations (already seen by the model) are
+      cut to TOOL_OUTPUT_TRIM_LENGTH characters.
+    - Above MAX_AGENT_MESSAGES, only the current prompt (last SystemMessage
+      and the HumanMessage after it) plus the most recent messages are kept.
+      The tail never starts with ToolMessages whose tool call was dropped.
+    """
+    last_ai = next(
+        (i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], AIMessage)),
+        -1,
+    )
+    
+    trimmed = []
+    for i, message in enumerate(messages):
+        if (
+            i < last_ai
+            and isinstance(message, ToolMessage)
+            and isinstance(message.content, str)
+            and len(message.content) > TOOL_OUTPUT_MAX_LENGTH
+        ):
+            message = message.model_copy(update={
+                "content": message.content[:TOOL_OUTPUT_TRIM_LENGTH] + "…[truncated]",
+            })
+        trimmed.append(message)
+    
+    if len(trimmed) <= MAX_AGENT_MESSAGES:
+        return trimmed
+    
+    prompt_start = next(
+        (i for i in range(len(trimmed) - 1, -1, -1) if isinstance(trimmed[i], SystemMessage)),
+        0,
+    )
+    head = trimmed[prompt_start:prompt_start + 2]
+    tail_start = max(len(trimmed) - AGENT_MESSAGES_TAIL, prompt_start + 2)
+    while tail_start < len(trimmed) and isinstance(trimmed[tail_start], ToolMessage):
+        tail_start += 1
+    
+    return head + trimmed[tail_start:]
+
+
+async def _astream_to_message(llm, messages: list) -> AIMessage:
+    """Stream an LLM call and aggregate the chunks into a single AIMessage."""
+    aggregated = None
+    async for chunk in llm.astream(messages):
+        aggregated = chunk if aggregated is None else aggregated + chunk
+    
+    if aggregated is None:
+        return AIMessage(content="")
+    return message_chunk_to_message(aggregated)
+
+
+def _parse_agent_output(content: str) -> AgentResponse:
+    """
+    Parse the agent's final JSON output (as specified in system prompt).
+    
+    Tries the raw content first, then the outermost {...} span in case the
+    model wrapped it in markdown. JSON that decodes but doesn't validate is
+    read field by field, so a bad field never loses the reply or the
+    escalation. Falls back to an empty AgentResponse (raw text, no
+    escalation) if no candidate is JSON.
+    """
+    candidates = [content]
+    json_match = _JSON_RE.search(content)
+    if json_match and json_match.group() != content:
+        candidates.append(json_match.group())
+    
+    for candidate in candidates:
+        try:
+            return AgentResponse.model_validate_json(candidate)
+        except ValidationError:
+            pass
+        try:
+            data = orjson.loads(candidate)
+        except orjson.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            return _agent_response_from_dict(data)
+    
+    return AgentResponse()
+
+
+def _agent_response_from_dict(data: dict) -> AgentResponse:
+    """Best-effort AgentResponse from decoded agent JSON that failed validation."""
+    text = data.get("response", data.get("response_text"))
+    escalation = data.get("escalation")
+    if not isinstance(escalation, dict):
+        escalation = {}
+    reason = escalation.get("reason")
+    return AgentResponse.model_construct(
+        response_text=text if isinstance(text, str) else None,
+        escalation=EscalationInfo.model_construct(
+            needed=bool(escalation.get("needed")),
+            reason="" if reason is None else str(reason),
+        ),
+    )
+
+
+async def _execute_tool_call(tool_call: dict) -> ToolMessage:
+    """Execute a single tool call and wrap the result as a ToolMessage."""
+    tool_name = tool_call["name"]
+    ainvoke = TOOL_DISPATCH.get(tool_name)
+
+    if ainvoke is None:
+        return ToolMessage(
+            content=f"Unknown tool: {tool_name}",
+            tool_call_id=tool_call["id"],
+        )
+
+    try:
+        tool_result = await ainvoke(tool_call["args"])
+    except Exception as e:
+        tool_result = f"Error executing {tool_name}: {str(e)}"
+
+    return ToolMessage(
+        content=str(tool_result),
+        tool_call_id=tool_call["id"],
+    )
+
+
 async def humanizer_node(state: FermerState) -> dict:
     """
     Node 6: Humanize AI response.
@@ -398,44 +697,26 @@ async def humanizer_node(state: FermerState) -> dict:
     if not state.get("response_text"):
         return {"humanized_response": ""}
     
-    humanizer_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.8)
-    
-    # Get current hour for time-based adaptation
-    current_hour = datetime.now().hour
-    if 6 <= current_hour < 11:
-        time_context = "утро - энергичный тон"
-    elif 11 <= current_hour < 17:
-        time_context = "день - деловой тон"
-    elif 17 <= current_hour < 23:
-        time_context = "вечер - спокойный тон"
-    else:
-        time_context = "ночь - лаконичный тон"
-    
-    humanizer_prompt = f"""
-Ты — Humanizer Agent. Твоя задача — сделать AI-ответ более живым и естественным.
-
-ПРАВИЛА:
-1. Сохрани ВСЮ информацию (цены, даты, имена)
-2. Время суток: {time_context}
-3. Используй "Вы" (формально)
-4. Не добавляй новой информации
-5. Макс 600 символов
-6. 1-3 коротких абзаца
-
-ЗАПРЕЩЕНО:
-- "Уважаемый", "С уважением"
-- Канцеляризмы
-- Добавлять то, чего нет в оригинале
-
-Оригинальный ответ:
-{state["response_text"]}
-
-Гуманизированная версия:
-"""
+    # Short replies are already natural enough — skip the extra LLM round-trip
+    if len(state["response_text"]) < HUMANIZER_MIN_LENGTH:
+        return {"humanized_response": state["response_text"]}
+    
+    humanizer_llm = _get_humanizer_llm()
+    
+    # Time-based tone adaptation
+    time_context = TONE_BY_HOUR[datetime.now().hour]
+    
+    humanizer_messages = [
+        HUMANIZER_SYSTEM_MESSAGE,
+        HumanMessage(content=f"[{time_context}]\n{state['response_text']}"),
+    ]
     
     try:
-        result = await humanizer_llm.ainvoke([HumanMessage(content=humanizer_prompt)])
-        return {"humanized_response": result.content}
+        # Stream tokens so stream_message() consumers see the reply as it is generated
+        chunks = []
+        async for chunk in humanizer_llm.astream(humanizer_messages):
+            chunks.append(chunk.content)
+        return {"humanized_response": "".join(chunks)}
     except Exception:
         # Fallback to original response
         return {"humanized_response": state["response_text"]}
@@ -459,8 +740,9 @@ async def send_response_node(state: FermerState) -> dict:
             source=state.get("source", "whatsapp"),
         )
         
-        # Log AI message to database
-        await log_message_to_db(
+        # Log AI message to database via the log queue — a slow or failing
+        # DB write must not delay the graph (escalation runs next)
+        _enqueue_message_log(
             query_id=state.get("query_id"),
             chat_id=state["chat_id"],
             user_id=state.get("user_id"),
@@ -487,52 +769,69 @@ async def handle_escalation_node(state: FermerState) -> dict:
     if not state.get("escalation_needed"):
         return {}
 
-    try:
-        # Get user info for notifications
-        user_data = state.get("user_data", {})
-        user_name = f"{user_data.get('firstName', '')} {user_data.get('lastName', '')}".strip() or "Unknown"
-        club_name = user_data.get("club", {}).get("name", "")
-
-        # 1. Notify Telegram group (equivalent to n8n "Send a text message" node)
-        tg_chat = state.get("club_tg_chat") or -1003234914487  # Default managers group
-
-        await notify_telegram(
-            chat_id=tg_chat,
-            message=f"🚨 <b>Эскалация</b>\n\n"
-                    f"👤 Клиент: {user_name}\n"
-                    f"📱 Chat ID: {state['sender_id']}\n"
-                    f"🏢 Клуб: {club_name}\n\n"
-                    f"❗ Причина: {state.get('escalation_reason', 'Не указана')}\n\n"
-                    f"💬 <b>Последнее сообщение:</b>\n"
-                    f"USER: {state['message']}\n\n"
-                    f"🤖 <b>Ответ AI:</b>\n"
-                    f"{state.get('response_text', '')[:500]}",
-        )
-
-        # 2. Create Notion page (equivalent to n8n "Create a database page2" node)
-        await create_notion_escalation(
-            chat_id=state["sender_id"],
-            user_name=user_name,
-            escalation_reason=state.get("escalation_reason", "Не указана"),
-            last_message=state["message"],
-            ai_response=state.get("response_text", ""),
-            club_name=club_name,
-        )
-
-        # 3. Update AmoCRM lead status (equivalent to n8n AmoCRM nodes)
-        await update_amocrm_lead(
+    # Get user info for notifications
+    user_data = state.get("user_data") or {}
+    user_name = f"{user_data.get('firstName', '')} {user_data.get('lastName', '')}".strip() or "Unknown"
+    club_name = (user_data.get("club") or {}).get("name", "")
+    escalation_reason = state.get("escalation_reason") or "Не указана"
+    response_text = state.get("response_text", "")
+
+    tg_chat = state.get("club_tg_chat") or DEFAULT_ESCALATION_TG_CHAT
+    tg_message = ESCALATION_TG_TEMPLATE.format_map({
+        "user_name": user_name,
+        "sender_id": state["sender_id"],
+        "club_name": club_name,
+        "reason": escalation_reason,
+        "message": state["message"],
+        "ai_response": response_text[:ESCALATION_TG_AI_RESPONSE_LENGTH],
+    })
+
+    # The Notion page is only a tracking record, so it's created in the
+    # background (failures are logged) and doesn't delay the escalation
+    # (n8n "Create a database page2" node)
+    _run_in_background(create_notion_escalation(
+        chat_id=state["sender_id"],
+        user_name=user_name,
+        escalation_reason=escalation_reason,
+        last_message=state["message"],
+        ai_response=response_text,
+        club_name=club_name,
+    ))
+
+    # Managers must be notified and the lead moved, so these two are awaited
+    # (concurrently) and their failures reported:
+    # 1. Telegram group (n8n "Send a text message" node)
+    # 2. AmoCRM lead status (n8n AmoCRM nodes)
+    actions = ("Telegram", "AmoCRM")
+    results = await asyncio.gather(
+        notify_telegram(chat_id=tg_chat, message=tg_message),
+        update_amocrm_lead(
             chat_id=state["sender_id"],
             status="human_needed",
-        )
+        ),
+        return_exceptions=True,
+    )
 
-        return {}
+    errors = [
+        f"{action}: {str(result)}"
+        for action, result in zip(actions, results)
+        if isinstance(result, Exception)
+    ]
+    if errors:
+        return {"error": f"Escalation failed: {'; '.join(errors)}"}
 
-    except Exception as e:
-        return {"error": f"Escalation failed: {str(e)}"}
+    return {}
 
 
 # ============== CONDITIONAL EDGES ==============
 
+def should_continue_after_extract(state: FermerState) -> Literal["fetch_fermer_data", "end"]:
+    """Skip the whole graph for messages filtered out by extract_message_data."""
+    if not state.get("should_respond", True):
+        return "end"
+    return "fetch_fermer_data"
+
+
 def should_continue_after_data(state: FermerState) -> Literal["select_trigger", "end"]:
     """Check if we have valid fermer data to continue."""
     if state.get("error") or not state.get("should_respond", True):
@@ -573,7 +872,15 @@ def create_fermer_graph():
     
     # Add edges
     workflow.add_edge(START, "extract_data")
-    workflow.add_edge("extract_data", "fetch_fermer_data")
+    
+    workflow.add_conditional_edges(
+        "extract_data",
+        should_continue_after_extract,
+        {
+            "fetch_fermer_data": "fetch_fermer_data",
+            "end": END,
+        }
+    )
     
     workflow.add_conditional_edges(
         "fetch_fermer_data",
@@ -600,8 +907,8 @@ def create_fermer_graph():
     
     workflow.add_edge("handle_escalation", END)
     
-    # Compile with checkpointer for state persistence
-    checkpointer = MemorySaver()
+    # Compile with checkpointer for state persistence (optional)
+    checkpointer = MemorySaver() if CHECKPOINTER == "memory" else None
     return workflow.compile(checkpointer=checkpointer)
 
 
@@ -631,7 +938,78 @@ async def process_message(
     Returns:
         Final state with response and escalation info
     """
-    initial_state = {
+    initial_state = _build_initial_state(chat_id, sender_id, message, source, channel_id)
+    config = {"configurable": {"thread_id": chat_id}}
+    
+    result = await fermer_graph.ainvoke(
+        initial_state, config, durability=CHECKPOINT_DURABILITY
+    )
+    
+    return {
+        "response_text": result.get("humanized_response") or result.get("response_text", ""),
+        "escalation_needed": result.get("escalation_needed", False),
+        "escalation_reason": result.get("escalation_reason", ""),
+        "error": result.get("error"),
+    }
+
+
+async def stream_message(
+    chat_id: str,
+    sender_id: str,
+    message: str,
+    source: str = "whatsapp",
+    channel_id: str = "",
+) -> AsyncIterator[str]:
+    """
+    Streaming variant of process_message.
+    
+    Runs the same graph but yields the humanized response token by token
+    as the humanizer LLM produces it, so callers can start delivering the
+    reply before generation finishes. If the humanizer was skipped (short
+    response), the final response is yielded as a single chunk.
+    
+    Args:
+        Same as process_message
+    
+    Yields:
+        Response text chunks
+    """
+    initial_state = _build_initial_state(chat_id, sender_id, message, source, channel_id)
+    config = {"configurable": {"thread_id": chat_id}}
+    
+    streamed = False
+    final_state = {}
+    
+    async for mode, chunk in fermer_graph.astream(
+        initial_state,
+        config,
+        stream_mode=["messages", "values"],
+        durability=CHECKPOINT_DURABILITY,
+    ):
+        if mode == "values":
+            final_state = chunk
+            continue
+        
+        message_chunk, metadata = chunk
+        if metadata.get("langgraph_node") == "humanizer" and message_chunk.content:
+            streamed = True
+            yield message_chunk.content
+    
+    if not streamed:
+        response = final_state.get("humanized_response") or final_state.get("response_text", "")
+        if response:
+            yield response
+
+
+def _build_initial_state(
+    chat_id: str,
+    sender_id: str,
+    message: str,
+    source: str,
+    channel_id: str,
+) -> dict:
+    """Build initial graph state from webhook input."""
+    return {
         "chat_id": chat_id,
         "sender_id": sender_id,
         "message": message,
@@ -639,18 +1017,7 @@ async def process_message(
         "channel_id": channel_id,
         "timestamp": datetime.now().isoformat(),
         "messages": [],
-        "messages_history": [],
+        "history_text": "",
         "triggers": {},
         "should_respond": True,
     }
-    
-    config = {"configurable": {"thread_id": chat_id}}
-    
-    result = await fermer_graph.ainvoke(initial_state, config)
-    
-    return {
-        "response_text": result.get("humanized_response") or result.get("response_text", ""),
-        "escalation_needed": result.get("escalation_needed", False),
-        "escalation_reason": result.get("escalation_reason", ""),
-        "error": result.get("error"),
-    }
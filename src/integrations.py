@@ -10,14 +10,27 @@ Migrated from n8n:
 - AmoCRM API
 """
 
+import asyncio
 import httpx
+import itertools
+import logging
+import orjson
 import os
-from typing import Optional, Literal
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Awaitable, Callable, Hashable, Optional, Literal
+
+
+logger = logging.getLogger(__name__)
 
 
 # ============== CONFIGURATION ==============
 
-GRAPHQL_ENDPOINT = "https://admin.herosjourney.kz/graphql"
+HJ_API = "https://admin.herosjourney.kz"
+GRAPHQL_ENDPOINT = f"{HJ_API}/graphql"
 HJ_AUTH_TOKEN = os.getenv("HJ_AUTH_TOKEN")
 
 WAZZUP_API = "https://api.wazzup24.com/v3"
@@ -35,30 +48,299 @@ AMOCRM_STATUS_HUMAN = "81914526"
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 NOTION_DATABASE_ID = "29b0a16f-4371-81cc-9794-ce306f1d13c6"  # From n8n workflow
 
+# Debug: "1" keeps at most one short-lived keep-alive connection per host
+# (helps diagnose connections reused across event loops)
+MINIMAL_KEEPALIVE = os.getenv("INTEGRATIONS_MINIMAL_KEEPALIVE") == "1"
+
+
+# ============== HTTP CLIENTS ==============
+
+# One HTTP/2 client per host: keep-alive avoids a new TCP + TLS handshake per
+# call, and concurrent requests to the same host are multiplexed over one
+# connection. Host, auth and timeout are baked in so call sites only pass
+# a path and payload.
+_CLIENT_CONFIG = {
+    "graphql": (HJ_API, {"Authorization": f"Bearer {HJ_AUTH_TOKEN}"}),
+    "wazzup": (WAZZUP_API, {"Authorization": f"Bearer {WAZZUP_TOKEN}"}),
+    "telegram": (f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}", {}),
+    "amocrm": (f"https://{AMOCRM_DOMAIN}/api/v4", {"Authorization": f"Bearer {AMOCRM_TOKEN}"}),
+    "notion": ("https://api.notion.com/v1", {
+        "Authorization": f"Bearer {NOTION_TOKEN}",
+        "Notion-Version": "2022-06-28",
+    }),
+}
+
+# Per-provider request timeout (seconds): fail fast instead of blocking the graph
+_CLIENT_TIMEOUTS = {
+    "graphql": 15.0,
+    "wazzup": 10.0,
+    "telegram": 5.0,
+    "amocrm": 5.0,
+    "notion": 10.0,
+}
+
+# Per-provider bulkhead: max concurrent in-flight requests (also the pool size)
+_CLIENT_CONCURRENCY = {
+    "graphql": 16,
+    "wazzup": 8,
+    "telegram": 8,
+    "amocrm": 8,
+    "notion": 4,
+}
+_semaphores = {name: asyncio.Semaphore(size) for name, size in _CLIENT_CONCURRENCY.items()}
+
+_http_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _get_client(name: Literal["graphql", "wazzup", "telegram", "amocrm", "notion"]) -> httpx.AsyncClient:
+    """Lazy initialization of the shared HTTP client for one host."""
+    client = _http_clients.get(name)
+    if client is None:
+        base_url, headers = _CLIENT_CONFIG[name]
+        if MINIMAL_KEEPALIVE:
+            limits = httpx.Limits(max_keepalive_connections=1, keepalive_expiry=1)
+        else:
+            limits = httpx.Limits(
+                max_connections=_CLIENT_CONCURRENCY[name],
+                max_keepalive_connections=8,
+                keepalive_expiry=60,
+            )
+        client = _http_clients[name] = httpx.AsyncClient(
+            base_url=base_url,
+            # Bodies are pre-serialized with orjson and sent as content=
+            headers={"Content-Type": "application/json", **headers},
+            http2=True,
+            limits=limits,
+            timeout=httpx.Timeout(_CLIENT_TIMEOUTS[name]),
+        )
+    return client
+
 
-# ============== GRAPHQL INTEGRATION ==============
+async def close_http_clients() -> None:
+    """Close all shared HTTP clients (called from the FastAPI lifespan)."""
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for client in clients:
+        await client.aclose()
 
-async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
+
+# ============== RELIABILITY ==============
+
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2  # seconds
+RETRY_MAX_DELAY = 2.0
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Statuses that guarantee the request was not processed (safe for any write)
+RETRY_STATUSES_UNPROCESSED = frozenset({429, 503})
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RECOVERY_TIME = 30.0  # seconds
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """
+    CLOSED → OPEN after BREAKER_FAILURE_THRESHOLD consecutive failures.
+    
+    While OPEN calls fail fast; after BREAKER_RECOVERY_TIME one trial call is
+    let through (HALF_OPEN) and its outcome closes or re-opens the circuit.
+    A trial that ends without an outcome (cancelled, unexpected error) is
+    released so the next call can probe again.
     """
-    Fetch fermer data from Hero's Journey GraphQL API.
     
-    Equivalent to n8n "get fermer data" node.
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
     
-    Args:
-        chat_id: User's chat ID (phone number)
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.trial_in_flight and time.monotonic() - self.opened_at >= BREAKER_RECOVERY_TIME:
+            self.trial_in_flight = True
+            return True
+        return False
     
-    Returns:
-        Fermer data dict or None if not found
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+    
+    def release_trial(self) -> None:
+        self.trial_in_flight = False
+
+
+_breakers = {name: _CircuitBreaker() for name in _CLIENT_CONFIG}
+
+
+async def request(
+    provider: Literal["graphql", "wazzup", "telegram", "amocrm", "notion"],
+    method: str,
+    path: str,
+    *,
+    idempotent: bool = True,
+    **kwargs,
+) -> httpx.Response:
     """
-    query = """
-    query FermerByChatId($chatId: String!) {
-        fermerByChatId(chatId: $chatId) {
+    Send a request to a provider with retries, a circuit breaker and a
+    bulkhead (at most _CLIENT_CONCURRENCY[provider] requests in flight).
+    
+    Retries use exponential backoff with full jitter. Non-idempotent calls
+    are only retried when the request was provably not processed
+    (connection failures, 429/503), so a retry never duplicates a write.
+    
+    Raises:
+        CircuitOpenError: the provider's breaker is open
+        httpx.TransportError: the request failed on every attempt
+    """
+    breaker = _breakers[provider]
+    if not breaker.allow():
+        raise CircuitOpenError(f"{provider} circuit is open")
+    # No await since allow(): a set opened_at means this call is the half-open trial
+    is_trial = breaker.opened_at is not None
+    
+    retry_statuses = RETRY_STATUSES if idempotent else RETRY_STATUSES_UNPROCESSED
+    
+    try:
+        client = _get_client(provider)
+        
+        for attempt in range(RETRY_ATTEMPTS):
+            last_attempt = attempt == RETRY_ATTEMPTS - 1
+            try:
+                async with _semaphores[provider]:
+                    response = await client.request(method, path, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                if last_attempt:
+                    breaker.record_failure()
+                    raise
+            except httpx.TransportError:
+                if last_attempt or not idempotent:
+                    breaker.record_failure()
+                    raise
+            else:
+                if response.status_code not in retry_statuses or last_attempt:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    return response
+            
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+    finally:
+        # Cancelled or failed with a non-transport error: don't leave the
+        # circuit waiting forever on a trial that will never report back
+        if is_trial and breaker.trial_in_flight:
+            breaker.release_trial()
+
+
+# ============== RESPONSE CACHES ==============
+
+FERMER_CACHE_TTL = 20  # seconds
+LEAD_CACHE_TTL = 60
+LEAD_ID_CACHE_TTL = 300  # a chat's lead id doesn't change
+
+
+class TTLCache:
+    """
+    Per-key TTL cache for upstream reads.
+    
+    Concurrent misses for the same key are coalesced behind a per-key lock,
+    so only one request goes upstream. Exceptions are not cached; if a
+    refresh fails, the expired entry (if any) is returned instead.
+    
+    Holds at most max_size entries: past that, expired entries are dropped
+    first, then the least recently used ones.
+    """
+    
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+    
+    def _lookup(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return True, entry[1]
+        return False, None
+    
+    def _store(self, key: Hashable, value) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            now = time.monotonic()
+            for stale in [k for k, e in self._entries.items() if e[0] <= now]:
+                del self._entries[stale]
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable]):
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+        
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                hit, value = self._lookup(key)
+                if hit:
+                    return value
+                
+                try:
+                    value = await fetch()
+                except Exception as e:
+                    # Stale-on-error: an expired entry beats no data
+                    entry = self._entries.get(key)
+                    if entry is None:
+                        raise
+                    logger.warning("Serving stale cache entry for %s: %s", key, e)
+                    return entry[1]
+                
+                self._store(key, value)
+                return value
+        finally:
+            if not lock.locked():
+                self._locks.pop(key, None)
+    
+    def set(self, key: Hashable, value) -> None:
+        self._store(key, value)
+    
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+    
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+_fermer_cache = TTLCache(FERMER_CACHE_TTL)
+_lead_cache = TTLCache(LEAD_CACHE_TTL)
+_lead_id_cache = TTLCache(LEAD_ID_CACHE_TTL)
+
+
+def invalidate_cached(chat_id: str) -> None:
+    """Drop cached fermer data and AmoCRM lead for a chat (after writes)."""
+    _fermer_cache.invalidate(chat_id)
+    _lead_cache.invalidate(chat_id)
+
+
+# ============== GRAPHQL INTEGRATION ==============
+
+# Selection sets shared by the FermerByChatId queries (single source of truth).
+# Duplicate fields across blocks (e.g. `user`) are merged by GraphQL.
+_FERMER_SUMMARY_FIELDS = """
             id
             userId
-            marathonEndDate
-            chatId
-            created_at
-            updated_at
             triggers {
                 payment
                 firstTraining
@@ -66,28 +348,42 @@ async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
                 finishProgram
                 notBuy
             }
-            queries {
-                id
-                adminId
-                created_at
-                dialog {
-                    text
-                    sender
-                    triggerType
-                    created_at
-                    trainingData {
+            user {
+                firstName
+                lastName
+                sex
+                club {
+                    id
+                    name
+                }
+            }"""
+
+# trainingData fields read by get_user_prompt
+_TRAINING_DATA_FIELDS = """
+                        eventName
+                        hasCheckedIn
+                        heartRateData {
+                            max_hr
+                            average_hr
+                        }
+                        eventRating {
+                            ratingByEvent
+                            ratingByTrainer
+                            commentByEvent
+                        }
+                        trainingCount
+                        totalCalories
+                        avgRatingByEvent"""
+
+_TRAINING_DATA_EXTRA_FIELDS = """
                         firstName
                         phoneNumber
                         bookingId
                         eventId
-                        eventName
                         eventEndTime
-                        hasCheckedIn
                         birthdayDate
                         userSex
                         heartRateData {
-                            max_hr
-                            average_hr
                             calories
                             dumbbells
                             weight
@@ -105,9 +401,6 @@ async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
                             id
                             value
                             comment
-                            ratingByEvent
-                            ratingByTrainer
-                            commentByEvent
                             commentByTrainer
                         }
                         lastMarathon {
@@ -133,27 +426,10 @@ async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
                             status
                         }
                         totalWeight
-                        trainingCount
-                        totalCalories
-                        avgRatingByEvent
                         avgRatingByTrainer
-                        allRatings
-                    }
-                }
-            }
-            user {
-                firstName
-                lastName
-                sex
-                tickets
-                club {
-                    id
-                    name
-                }
-                age
-                weight
-                height
-            }
+                        allRatings"""
+
+_USER_PROFILE_FIELDS = """
             userProfile {
                 goal
                 fitnessLevel
@@ -176,27 +452,121 @@ async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
                 last_stage_change_at
                 collectedAt
                 completeness
-            }
-        }
-    }
+            }"""
+
+
+def _dialog_fields(training_data_fields: str) -> str:
+    return f"""
+            queries {{
+                id
+                adminId
+                created_at
+                dialog {{
+                    text
+                    sender
+                    triggerType
+                    created_at
+                    trainingData {{{training_data_fields}
+                    }}
+                }}
+            }}"""
+
+
+def _fermer_query(fields: str) -> str:
+    return f"""
+    query FermerByChatId($chatId: String!) {{
+        fermerByChatId(chatId: $chatId) {{{fields}
+        }}
+    }}
     """
+
+
+# id, userId, triggers and basic user info
+FERMER_SUMMARY_QUERY = _fermer_query(_FERMER_SUMMARY_FIELDS)
+
+# What the agent graph reads: summary, dialogs, prompt training data, profile
+FERMER_DATA_QUERY = _fermer_query(
+    _FERMER_SUMMARY_FIELDS
+    + _dialog_fields(_TRAINING_DATA_FIELDS)
+    + _USER_PROFILE_FIELDS
+)
+
+# Everything the backend exposes for a fermer (escalation/debug paths)
+FERMER_FULL_QUERY = _fermer_query(
+    _FERMER_SUMMARY_FIELDS
+    + """
+            marathonEndDate
+            chatId
+            created_at
+            updated_at
+            user {
+                tickets
+                age
+                weight
+                height
+            }"""
+    + _dialog_fields(_TRAINING_DATA_FIELDS + _TRAINING_DATA_EXTRA_FIELDS)
+    + _USER_PROFILE_FIELDS
+)
+
+
+async def _query_fermer(query: str, chat_id: str) -> Optional[dict]:
+    response = await request(
+        "graphql", "POST", "/graphql",
+        content=orjson.dumps({
+            "query": query,
+            "variables": {"chatId": chat_id}
+        }),
+    )
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            GRAPHQL_ENDPOINT,
-            json={
-                "query": query,
-                "variables": {"chatId": chat_id}
-            },
-            headers={
-                "Authorization": f"Bearer {HJ_AUTH_TOKEN}",
-                "Content-Type": "application/json",
-            },
-            timeout=30.0,
-        )
-        
-        data = response.json()
-        return data.get("data", {}).get("fermerByChatId")
+    data = orjson.loads(response.content)
+    return data.get("data", {}).get("fermerByChatId")
+
+
+async def fetch_fermer_data(chat_id: str) -> Optional[dict]:
+    """
+    Fetch fermer data from Hero's Journey GraphQL API.
+    
+    Equivalent to n8n "get fermer data" node. Requests only the fields the
+    agent graph reads (FERMER_DATA_QUERY). Cached per chat for
+    FERMER_CACHE_TTL seconds; log_message_to_db invalidates the entry.
+    
+    Args:
+        chat_id: User's chat ID (phone number)
+    
+    Returns:
+        Fermer data dict or None if not found
+    """
+    return await _fermer_cache.get_or_fetch(
+        chat_id,
+        lambda: _query_fermer(FERMER_DATA_QUERY, chat_id),
+    )
+
+
+async def fetch_fermer_summary(chat_id: str) -> Optional[dict]:
+    """
+    Fetch id, userId, triggers and basic user info for a fermer.
+    
+    Args:
+        chat_id: User's chat ID (phone number)
+    
+    Returns:
+        Fermer summary dict or None if not found
+    """
+    return await _query_fermer(FERMER_SUMMARY_QUERY, chat_id)
+
+
+async def fetch_fermer_full(chat_id: str) -> Optional[dict]:
+    """
+    Fetch every fermer field, including full training data of each dialog message.
+    
+    Args:
+        chat_id: User's chat ID (phone number)
+    
+    Returns:
+        Fermer data dict or None if not found
+    """
+    return await _query_fermer(FERMER_FULL_QUERY, chat_id)
 
 
 async def log_message_to_db(
@@ -221,47 +591,126 @@ async def log_message_to_db(
     Returns:
         True if successful
     """
-    # Escape special characters for GraphQL
-    escaped_text = (
-        text.replace("\\", "\\\\")
-            .replace('"', '\\"')
-            .replace("\n", "\\n")
-            .replace("\r", "\\r")
-            .replace("\t", "\\t")
-    )
+    # The mutation's ids are non-null: one missing id would make the server
+    # reject every message batched with it
+    if not (query_id and chat_id and user_id) or text is None:
+        logger.warning("Not logging message for chat %s: missing query/user id", chat_id)
+        return False
     
-    mutation = f"""
-    mutation AddFermerMessage {{
-        addFermerMessage(
-            queryId: "{query_id}"
-            message: {{ text: "{escaped_text}", sender: "{sender}" }}
-            chatId: "{chat_id}"
-            userId: "{user_id}"
-        ) {{
-            id
-            userId
-            chatId
-        }}
-    }}
+    # Concurrent calls (e.g. a batch from the graph's log queue) are sent
+    # as one GraphQL request
+    ok = await _log_batcher.submit({
+        "query_id": query_id,
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "text": text,
+        "sender": sender,
+    })
+    _fermer_cache.invalidate(chat_id)
+    return ok
+
+
+# Parameterized addFermerMessage: the document depends only on the batch size,
+# so the server can reuse its parsed/validated query and no escaping is needed
+_ADD_FERMER_MESSAGE_VARIABLES = (
+    "$queryId{i}: ID!, $chatId{i}: String!, $userId{i}: ID!, $text{i}: String!, $sender{i}: String!"
+)
+_ADD_FERMER_MESSAGE_FIELD = (
+    "m{i}: addFermerMessage(queryId: $queryId{i}, message: {{text: $text{i}, sender: $sender{i}}}, "
+    "chatId: $chatId{i}, userId: $userId{i}) {{ id userId chatId }}"
+)
+
+
+@lru_cache(maxsize=32)
+def _add_fermer_messages_mutation(count: int) -> str:
+    """Mutation document with `count` aliased addFermerMessage fields (m0, m1, ...)."""
+    variables = ", ".join(_ADD_FERMER_MESSAGE_VARIABLES.format(i=i) for i in range(count))
+    fields = " ".join(_ADD_FERMER_MESSAGE_FIELD.format(i=i) for i in range(count))
+    return f"mutation AddFermerMessages({variables}) {{ {fields} }}"
+
+
+class _GraphQLBatcher:
     """
+    Coalesces addFermerMessage calls issued within `window` seconds into one
+    request: each call becomes an aliased field (m0, m1, ...) of a single
+    mutation document and gets back the result for its own alias.
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            GRAPHQL_ENDPOINT,
-            json={"query": mutation},
-            headers={
-                "Authorization": f"Bearer {HJ_AUTH_TOKEN}",
-                "Content-Type": "application/json",
-            },
-            timeout=30.0,
-        )
+    If the server rejects the whole document (errors and no data, e.g. a
+    variable failed validation, so nothing was executed), each call is
+    resent on its own so one bad entry doesn't fail the others.
+    """
+    
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+    
+    def submit(self, fields: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((fields, future))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return future
+    
+    def _flush(self) -> None:
+        batch, self._pending = self._pending, []
+        self._flush_handle = None
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        variables = {}
+        for i, (fields, _) in enumerate(batch):
+            variables[f"queryId{i}"] = fields["query_id"]
+            variables[f"chatId{i}"] = fields["chat_id"]
+            variables[f"userId{i}"] = fields["user_id"]
+            variables[f"text{i}"] = fields["text"]
+            variables[f"sender{i}"] = fields["sender"]
+        
+        try:
+            response = await request(
+                "graphql", "POST", "/graphql",
+                idempotent=False,
+                content=orjson.dumps({
+                    "query": _add_fermer_messages_mutation(len(batch)),
+                    "variables": variables,
+                }),
+            )
+            data = orjson.loads(response.content)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
         
-        data = response.json()
-        return "errors" not in data
+        if data.get("data") is None and len(batch) > 1:
+            await asyncio.gather(*(self._send([entry]) for entry in batch))
+            return
+        
+        # Errors carry the alias of the failed field as the first path element
+        failed = {
+            (error.get("path") or [None])[0]
+            for error in data.get("errors") or []
+        }
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(f"m{i}" not in failed and None not in failed)
+
+
+GRAPHQL_BATCH_WINDOW = 0.01  # seconds
+_log_batcher = _GraphQLBatcher(GRAPHQL_BATCH_WINDOW)
 
 
 # ============== WAZZUP INTEGRATION ==============
 
+# Makes crmMessageId unique for sends within the same clock tick (Wazzup
+# drops messages with a repeated crmMessageId)
+_crm_message_counter = itertools.count()
+
+
 async def send_whatsapp_message(
     chat_id: str,
     channel_id: str,
@@ -282,26 +731,19 @@ async def send_whatsapp_message(
     Returns:
         True if successful
     """
-    import time
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{WAZZUP_API}/message",
-            json={
-                "channelId": channel_id,
-                "chatType": source,
-                "crmMessageId": f"msg-{int(time.time() * 1000)}",
-                "chatId": chat_id,
-                "text": text,
-            },
-            headers={
-                "Authorization": f"Bearer {WAZZUP_TOKEN}",
-                "Content-Type": "application/json",
-            },
-            timeout=30.0,
-        )
-        
-        return response.status_code == 200
+    # crmMessageId makes Wazzup drop duplicates, so retries are safe
+    response = await request(
+        "wazzup", "POST", "/message",
+        content=orjson.dumps({
+            "channelId": channel_id,
+            "chatType": source,
+            "crmMessageId": f"msg-{time.time_ns()}-{next(_crm_message_counter)}",
+            "chatId": chat_id,
+            "text": text,
+        }),
+    )
+    
+    return response.status_code == 200
 
 
 # ============== TELEGRAM INTEGRATION ==============
@@ -322,25 +764,24 @@ async def notify_telegram(
     Returns:
         True if successful
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json={
-                "chat_id": chat_id,
-                "text": message,
-                "parse_mode": "HTML",
-            },
-            timeout=30.0,
-        )
-        
-        return response.status_code == 200
+    response = await request(
+        "telegram", "POST", "/sendMessage",
+        idempotent=False,
+        content=orjson.dumps({
+            "chat_id": chat_id,
+            "text": message,
+            "parse_mode": "HTML",
+        }),
+    )
+    
+    return response.status_code == 200
 
 
 # ============== AMOCRM INTEGRATION ==============
 
 async def get_lead_by_chat_id(chat_id: str) -> Optional[dict]:
     """
-    Find AmoCRM lead by chat ID.
+    Find AmoCRM lead by chat ID (cached for LEAD_CACHE_TTL seconds).
     
     Args:
         chat_id: User's chat ID
@@ -348,22 +789,23 @@ async def get_lead_by_chat_id(chat_id: str) -> Optional[dict]:
     Returns:
         Lead data or None
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"https://{AMOCRM_DOMAIN}/api/v4/leads",
+    async def fetch() -> Optional[dict]:
+        response = await request(
+            "amocrm", "GET", "/leads",
             params={
                 "query": chat_id,
                 "filter[pipeline_id]": AMOCRM_PIPELINE_ID,
             },
-            headers={
-                "Authorization": f"Bearer {AMOCRM_TOKEN}",
-            },
-            timeout=30.0,
         )
         
-        data = response.json()
+        # AmoCRM answers 204 with an empty body when nothing matches
+        if response.status_code == 204:
+            return None
+        data = orjson.loads(response.content)
         leads = data.get("_embedded", {}).get("leads", [])
         return leads[0] if leads else None
+    
+    return await _lead_cache.get_or_fetch(chat_id, fetch)
 
 
 async def update_amocrm_lead(
@@ -382,53 +824,136 @@ async def update_amocrm_lead(
     Returns:
         True if successful
     """
-    # Get existing lead
-    lead = await get_lead_by_chat_id(chat_id)
+    # Usually a cache hit, so the PATCH goes out without a lookup round-trip
+    lead_id = await _lead_id_for(chat_id)
     
     status_id = AMOCRM_STATUS_INITIAL if status == "initial" else AMOCRM_STATUS_HUMAN
     
-    if lead:
+    if lead_id:
         # Update existing lead
-        async with httpx.AsyncClient() as client:
-            response = await client.patch(
-                f"https://{AMOCRM_DOMAIN}/api/v4/leads/{lead['id']}",
-                json={
-                    "status_id": int(status_id),
-                },
-                headers={
-                    "Authorization": f"Bearer {AMOCRM_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            return response.status_code == 200
+        response = await request(
+            "amocrm", "PATCH", f"/leads/{lead_id}",
+            content=orjson.dumps({
+                "status_id": int(status_id),
+            }),
+        )
+        _lead_cache.invalidate(chat_id)
+        return response.status_code == 200
     else:
         # Create new lead
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://{AMOCRM_DOMAIN}/api/v4/leads",
-                json=[{
-                    "name": f"Fermer Lead {chat_id}",
-                    "pipeline_id": int(AMOCRM_PIPELINE_ID),
-                    "status_id": int(status_id),
-                    "custom_fields_values": [
-                        {
-                            "field_id": 3031325,  # custom_chatid_field_id
-                            "values": [{"value": chat_id}]
-                        }
-                    ]
-                }],
-                headers={
-                    "Authorization": f"Bearer {AMOCRM_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            return response.status_code == 200
+        response = await request(
+            "amocrm", "POST", "/leads",
+            idempotent=False,
+            content=orjson.dumps([{
+                "name": f"Fermer Lead {chat_id}",
+                "pipeline_id": int(AMOCRM_PIPELINE_ID),
+                "status_id": int(status_id),
+                "custom_fields_values": [
+                    {
+                        "field_id": 3031325,  # custom_chatid_field_id
+                        "values": [{"value": chat_id}]
+                    }
+                ]
+            }]),
+        )
+        _lead_cache.invalidate(chat_id)
+        if response.status_code != 200:
+            return False
+        
+        created = orjson.loads(response.content).get("_embedded", {}).get("leads", [])
+        if created:
+            _lead_id_cache.set(chat_id, created[0]["id"])
+        else:
+            _lead_id_cache.invalidate(chat_id)
+        return True
+
+
+async def _lead_id_for(chat_id: str) -> Optional[int]:
+    """AmoCRM lead id for a chat, cached for LEAD_ID_CACHE_TTL seconds."""
+    async def fetch() -> Optional[int]:
+        lead = await get_lead_by_chat_id(chat_id)
+        return lead["id"] if lead else None
+    
+    return await _lead_id_cache.get_or_fetch(chat_id, fetch)
 
 
 # ============== NOTION INTEGRATION ==============
 
+# Escalation page body, serialized once; each "@slot@" string is replaced by
+# the JSON-encoded per-call value in _render_notion_page
+_NOTION_PAGE_TEMPLATE = orjson.dumps({
+    "parent": {"database_id": NOTION_DATABASE_ID},
+    "properties": {
+        "Name": {
+            "title": [
+                {"text": {"content": "@title@"}}
+            ]
+        },
+        "Chat ID": {
+            "rich_text": [
+                {"text": {"content": "@chat_id@"}}
+            ]
+        },
+        "Reason": {
+            "rich_text": [
+                {"text": {"content": "@reason@"}}
+            ]
+        },
+        "Club": {
+            "rich_text": [
+                {"text": {"content": "@club@"}}
+            ]
+        },
+        "Status": {
+            "select": {"name": "New"}
+        },
+        "Created": {
+            "date": {"start": "@created@"}
+        },
+    },
+    "children": [
+        {
+            "object": "block",
+            "type": "heading_2",
+            "heading_2": {
+                "rich_text": [{"text": {"content": "Last User Message"}}]
+            }
+        },
+        {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": [{"text": {"content": "@last_message@"}}]
+            }
+        },
+        {
+            "object": "block",
+            "type": "heading_2",
+            "heading_2": {
+                "rich_text": [{"text": {"content": "AI Response"}}]
+            }
+        },
+        {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": [{"text": {"content": "@ai_response@"}}]
+            }
+        },
+    ]
+})
+
+
+def _render_notion_page(**values: str) -> bytes:
+    """Fill _NOTION_PAGE_TEMPLATE slots with JSON-encoded values."""
+    # Encoded values escape their quotes, so an inserted value can never
+    # contain a later slot's quoted marker
+    body = _NOTION_PAGE_TEMPLATE
+    for slot, value in values.items():
+        body = body.replace(f'"@{slot}@"'.encode(), orjson.dumps(value))
+    return body
+
+
 async def create_notion_escalation(
     chat_id: str,
     user_name: str,
@@ -456,90 +981,41 @@ async def create_notion_escalation(
     if not NOTION_TOKEN:
         return False
 
-    from datetime import datetime
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.notion.com/v1/pages",
-            json={
-                "parent": {"database_id": NOTION_DATABASE_ID},
-                "properties": {
-                    "Name": {
-                        "title": [
-                            {"text": {"content": f"Escalation: {user_name} ({chat_id})"}}
-                        ]
-                    },
-                    "Chat ID": {
-                        "rich_text": [
-                            {"text": {"content": chat_id}}
-                        ]
-                    },
-                    "Reason": {
-                        "rich_text": [
-                            {"text": {"content": escalation_reason}}
-                        ]
-                    },
-                    "Club": {
-                        "rich_text": [
-                            {"text": {"content": club_name}}
-                        ]
-                    },
-                    "Status": {
-                        "select": {"name": "New"}
-                    },
-                    "Created": {
-                        "date": {"start": datetime.now().isoformat()}
-                    },
-                },
-                "children": [
-                    {
-                        "object": "block",
-                        "type": "heading_2",
-                        "heading_2": {
-                            "rich_text": [{"text": {"content": "Last User Message"}}]
-                        }
-                    },
-                    {
-                        "object": "block",
-                        "type": "paragraph",
-                        "paragraph": {
-                            "rich_text": [{"text": {"content": last_message}}]
-                        }
-                    },
-                    {
-                        "object": "block",
-                        "type": "heading_2",
-                        "heading_2": {
-                            "rich_text": [{"text": {"content": "AI Response"}}]
-                        }
-                    },
-                    {
-                        "object": "block",
-                        "type": "paragraph",
-                        "paragraph": {
-                            "rich_text": [{"text": {"content": ai_response}}]
-                        }
-                    },
-                ]
-            },
-            headers={
-                "Authorization": f"Bearer {NOTION_TOKEN}",
-                "Content-Type": "application/json",
-                "Notion-Version": "2022-06-28",
-            },
-            timeout=30.0,
-        )
+    response = await request(
+        "notion", "POST", "/pages",
+        idempotent=False,
+        content=_render_notion_page(
+            title=f"Escalation: {user_name} ({chat_id})",
+            chat_id=chat_id,
+            reason=escalation_reason,
+            club=club_name,
+            created=datetime.now().isoformat(),
+            last_message=last_message,
+            ai_response=ai_response,
+        ),
+    )
 
-        return response.status_code == 200
+    return response.status_code == 200
 
 
 # ============== EXPORT ==============
 
 __all__ = [
     "fetch_fermer_data",
+    "fetch_fermer_summary",
+    "fetch_fermer_full",
     "log_message_to_db",
     "send_whatsapp_message",
     "notify_telegram",
     "update_amocrm_lead",
     "create_notion_escalation",
+    "close_http_clients",
+    "invalidate_cached",
+    "request",
+    "TTLCache",
+    "CircuitOpenError",
+    "RETRY_ATTEMPTS",
+    "RETRY_BASE_DELAY",
+    "RETRY_MAX_DELAY",
+    "RETRY_STATUSES",
 ]
@@ -13,40 +13,43 @@ Migrated from n8n:
 
 from typing import Optional
 from datetime import datetime
+from itertools import islice
+import time
 
 
-# ============== SYSTEM PROMPTS ==============
+# ============== CURRENT TIME ==============
 
-def get_system_prompt(
-    trigger_type: str,
-    user_data: dict,
-    user_profile: dict,
-) -> str:
-    """
-    Get system prompt based on trigger type.
-    
-    Args:
-        trigger_type: first_training, no_activity, finish_program, payment, default
-        user_data: User data from GraphQL
-        user_profile: User profile from GraphQL
-    
-    Returns:
-        System prompt string
-    """
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
+# (epoch_minute, formatted) — prompts only show minute resolution
+_current_time_cache: tuple[int, str] = (-1, "")
+
+
+def _cached_current_time() -> str:
+    """Get "%d.%m.%Y %H:%M" for now, formatted at most once per minute."""
+    global _current_time_cache
     
-    base_role = """<role>
+    epoch_minute = int(time.time()) // 60
+    cached_minute, formatted = _current_time_cache
+    if cached_minute != epoch_minute:
+        formatted = datetime.now().strftime("%d.%m.%Y %H:%M")
+        _current_time_cache = (epoch_minute, formatted)
+    return formatted
+
+
+# ============== SYSTEM PROMPTS ==============
+
+# Static XML fragments shared by all triggers (built once at import)
+_BASE_ROLE = """<role>
 You are Batyr, consultant at Hero's Journey fitness studio in Almaty, Kazakhstan.
 You communicate in Russian, using formal "Вы" (You).
 </role>"""
 
-    tools_section = """<available_tools>
+_TOOLS_SECTION = """<available_tools>
   <tool name="get_schedule_by_club">Get training schedule for any club</tool>
   <tool name="search_knowledge_base">Search FAQ, prices, objection handling scripts</tool>
   <tool name="get_payment_link">Generate payment link for products</tool>
 </available_tools>"""
 
-    output_format = """<output_requirements>
+_OUTPUT_FORMAT = """<output_requirements>
   <language>Russian</language>
   <format>JSON without markdown wrapper</format>
   <schema>
@@ -65,7 +68,7 @@ You communicate in Russian, using formal "Вы" (You).
   </constraints>
 </output_requirements>"""
 
-    escalation_triggers = """<escalation_triggers>
+_ESCALATION_TRIGGERS = """<escalation_triggers>
   <trigger priority="critical">
     <keywords>острая боль, сильная боль, не могу наступать, не могу двигать, опухло, онемение</keywords>
     <action>escalate immediately</action>
@@ -76,7 +79,7 @@ You communicate in Russian, using formal "Вы" (You).
   </trigger>
 </escalation_triggers>"""
 
-    rules = """<rules>
+_RULES = """<rules>
   <rule priority="critical">Never give medical diagnoses</rule>
   <rule priority="critical">If pain/concerning symptoms → escalate to manager</rule>
   <rule priority="high">Always use formal "Вы" in Russian</rule>
@@ -85,8 +88,10 @@ You communicate in Russian, using formal "Вы" (You).
   <rule priority="medium">Do not confuse workouts (тренировка) and programs (программы)</rule>
 </rules>"""
 
-    if trigger_type == "first_training":
-        mission = """<mission>
+
+# ---- first_training ----
+
+_MISSION_FIRST_TRAINING = """<mission>
 Help the athlete after their first training:
 1. Analyze their first workout data (heart rate, calories, ratings)
 2. Check their wellbeing and recovery status
@@ -99,7 +104,7 @@ Help the athlete after their first training:
 Your ultimate goal is to help them solidify success with a second workout and establish a training habit.
 </mission>"""
 
-        intensity_guide = """<intensity_classification>
+_INTENSITY_GUIDE = """<intensity_classification>
   <level name="light">
     <criteria>Calories < 400 AND Average HR < 130</criteria>
     <recovery_advice>Вода в течение дня, 10-15 мин растяжки</recovery_advice>
@@ -117,26 +122,24 @@ Your ultimate goal is to help them solidify success with a second workout and es
   </level>
 </intensity_classification>"""
 
-        return f"""{base_role}
+_SYSTEM_TEMPLATE_FIRST_TRAINING = f"""{_BASE_ROLE}
 
-{mission}
+{_MISSION_FIRST_TRAINING}
 
-{intensity_guide}
+{_INTENSITY_GUIDE}
 
-{rules}
+{_RULES}
 
-{escalation_triggers}
+{_ESCALATION_TRIGGERS}
 
-{tools_section}
+{_TOOLS_SECTION}
 
-{output_format}
+{_OUTPUT_FORMAT}"""
 
-<additional_context>
-  <current_date>{current_time}</current_date>
-</additional_context>"""
 
-    elif trigger_type == "no_activity":
-        mission = """<mission>
+# ---- no_activity ----
+
+_MISSION_NO_ACTIVITY = """<mission>
 Re-engage the athlete who hasn't trained recently:
 1. Check on their wellbeing (non-judgmental)
 2. Understand barriers to training
@@ -147,9 +150,9 @@ Re-engage the athlete who hasn't trained recently:
 Your goal is to help them get back on track without making them feel guilty.
 </mission>"""
 
-        return f"""{base_role}
+_SYSTEM_TEMPLATE_NO_ACTIVITY = f"""{_BASE_ROLE}
 
-{mission}
+{_MISSION_NO_ACTIVITY}
 
 <reengagement_strategies>
   <strategy name="empathy_first">
@@ -163,18 +166,16 @@ Your goal is to help them get back on track without making them feel guilty.
   </strategy>
 </reengagement_strategies>
 
-{rules}
+{_RULES}
 
-{tools_section}
+{_TOOLS_SECTION}
 
-{output_format}
+{_OUTPUT_FORMAT}"""
 
-<additional_context>
-  <current_date>{current_time}</current_date>
-</additional_context>"""
 
-    elif trigger_type == "finish_program":
-        mission = """<mission>
+# ---- finish_program ----
+
+_MISSION_FINISH_PROGRAM = """<mission>
 Help the athlete who completed their trial program:
 1. Congratulate on completing the program
 2. Review their achievements and progress
@@ -185,7 +186,7 @@ Help the athlete who completed their trial program:
 Your goal is to convert trial users to full members by showing value.
 </mission>"""
 
-        pricing = """<pricing_reference>
+_PRICING_FINISH_PROGRAM = """<pricing_reference>
   <product name="Hero's Pass 6 месяцев" price="349 990 ₸">
     <installment>Рассрочка 0-0-12 через Kaspi</installment>
   </product>
@@ -195,11 +196,11 @@ Your goal is to convert trial users to full members by showing value.
   </product>
 </pricing_reference>"""
 
-        return f"""{base_role}
+_SYSTEM_TEMPLATE_FINISH_PROGRAM = f"""{_BASE_ROLE}
 
-{mission}
+{_MISSION_FINISH_PROGRAM}
 
-{pricing}
+{_PRICING_FINISH_PROGRAM}
 
 <conversion_strategy>
   <step>1. Celebrate their achievement</step>
@@ -210,18 +211,16 @@ Your goal is to convert trial users to full members by showing value.
   <step>6. If ready → provide payment link</step>
 </conversion_strategy>
 
-{rules}
+{_RULES}
 
-{tools_section}
+{_TOOLS_SECTION}
 
-{output_format}
+{_OUTPUT_FORMAT}"""
 
-<additional_context>
-  <current_date>{current_time}</current_date>
-</additional_context>"""
 
-    elif trigger_type == "payment":
-        mission = """<mission>
+# ---- payment ----
+
+_MISSION_PAYMENT = """<mission>
 Assist with payment-related inquiries:
 1. Answer questions about pricing, installments, discounts
 2. Explain product differences (trials vs Hero's Pass)
@@ -231,7 +230,7 @@ Assist with payment-related inquiries:
 Your goal is to facilitate smooth payment experience.
 </mission>"""
 
-        pricing = """<pricing_reference>
+_PRICING_PAYMENT = """<pricing_reference>
   <trials>
     <product name="Hero's Week" price="9 990 ₸">1 неделя, 7 тренировок</product>
     <product name="Basecamp" price="29 990 ₸">2 недели, 14 тренировок</product>
@@ -244,11 +243,11 @@ Your goal is to facilitate smooth payment experience.
   <installment>Рассрочка 0-0-12 через Kaspi доступна на Hero's Pass</installment>
 </pricing_reference>"""
 
-        return f"""{base_role}
+_SYSTEM_TEMPLATE_PAYMENT = f"""{_BASE_ROLE}
 
-{mission}
+{_MISSION_PAYMENT}
 
-{pricing}
+{_PRICING_PAYMENT}
 
 <payment_flow>
   <step>1. Clarify which product interests them</step>
@@ -257,18 +256,16 @@ Your goal is to facilitate smooth payment experience.
   <step>4. When ready → use get_payment_link tool</step>
 </payment_flow>
 
-{rules}
+{_RULES}
 
-{tools_section}
+{_TOOLS_SECTION}
 
-{output_format}
+{_OUTPUT_FORMAT}"""
 
-<additional_context>
-  <current_date>{current_time}</current_date>
-</additional_context>"""
 
-    else:  # default - sales agent
-        mission = """<mission>
+# ---- default - sales agent ----
+
+_MISSION_DEFAULT = """<mission>
 General customer support and sales assistance:
 1. Answer questions about Hero's Journey
 2. Help with scheduling and bookings
@@ -279,9 +276,9 @@ General customer support and sales assistance:
 Your goal is to be helpful while nurturing interest in Hero's Journey.
 </mission>"""
 
-        return f"""{base_role}
+_SYSTEM_TEMPLATE_DEFAULT = f"""{_BASE_ROLE}
 
-{mission}
+{_MISSION_DEFAULT}
 
 <response_strategy>
   <rule>ALWAYS search knowledge base before answering product/pricing questions</rule>
@@ -290,51 +287,58 @@ Your goal is to be helpful while nurturing interest in Hero's Journey.
   <rule>Never make up prices or conditions</rule>
 </response_strategy>
 
-{rules}
+{_RULES}
 
-{tools_section}
+{_TOOLS_SECTION}
 
-{output_format}
+{_OUTPUT_FORMAT}"""
 
-<additional_context>
-  <current_date>{current_time}</current_date>
-</additional_context>"""
 
+def _compact_prompt(prompt: str) -> str:
+    """Drop indentation and blank lines: the XML tags already carry the structure."""
+    return "\n".join(line.strip() for line in prompt.splitlines() if line.strip())
 
-# ============== USER PROMPTS ==============
 
-def get_user_prompt(
-    trigger_type: str,
-    message: str,
-    messages_history: list[str],
-    training_data: dict,
-    user_data: dict,
-) -> str:
+# Full system prompt per trigger type. Deliberately free of per-request data
+# (the current date lives in the user prompt) so the provider can reuse its
+# prompt cache for this prefix across all calls of the same trigger.
+_SYSTEM_TEMPLATES = {
+    trigger_type: _compact_prompt(template)
+    for trigger_type, template in {
+        "first_training": _SYSTEM_TEMPLATE_FIRST_TRAINING,
+        "no_activity": _SYSTEM_TEMPLATE_NO_ACTIVITY,
+        "finish_program": _SYSTEM_TEMPLATE_FINISH_PROGRAM,
+        "payment": _SYSTEM_TEMPLATE_PAYMENT,
+        "default": _SYSTEM_TEMPLATE_DEFAULT,
+    }.items()
+}
+
+
+def get_system_prompt(trigger_type: str) -> str:
     """
-    Get user prompt based on trigger type and context.
+    Get system prompt based on trigger type.
+    
+    User-specific context goes into the user prompt, so this is a plain
+    lookup of the prebuilt template for the trigger.
     
     Args:
         trigger_type: first_training, no_activity, finish_program, payment, default
-        message: Current user message
-        messages_history: Previous messages in conversation
-        training_data: Training performance data
-        user_data: User profile data
     
     Returns:
-        User prompt string
+        System prompt string
     """
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-    
-    # Format conversation history
-    history_text = "\n".join(messages_history[-10:]) if messages_history else "NO PREVIOUS CONVERSATION"
-    
-    # Format user info
-    user_name = user_data.get("firstName", "Клиент")
-    user_sex = user_data.get("sex", "Not specified")
-    club_name = user_data.get("club", {}).get("name", "Not specified")
-    
-    base_context = f"""<current_message>
-{message or "NO MESSAGE — initiate proactive check-in"}
+    return _SYSTEM_TEMPLATES.get(trigger_type, _SYSTEM_TEMPLATES["default"])
+
+
+# ============== USER PROMPTS ==============
+
+# Most recent dialog messages shown to the agent
+HISTORY_LIMIT = 10
+
+# Shared context block; every per-trigger template embeds it, and all
+# placeholders are filled with a single format_map call
+_USER_BASE_CONTEXT = """<current_message>
+{message}
 </current_message>
 
 <athlete_context>
@@ -353,38 +357,31 @@ def get_user_prompt(
   <current_date>{current_time}</current_date>
 </additional_info>"""
 
-    if trigger_type == "first_training":
-        # Extract training performance data
-        hr_data = training_data.get("heartRateData", {})
-        event_rating = training_data.get("eventRating", {})
-        
-        training_context = f"""<first_workout_data>
-    <workout_name>{training_data.get("eventName", "N/A")}</workout_name>
-    <date>{training_data.get("CheckedIndate", "N/A")}</date>
-    <checked_in>{training_data.get("hasCheckedIn", False)}</checked_in>
+_USER_TEMPLATE_FIRST_TRAINING = """<task>
+Athlete completed their first training. Respond to their message OR initiate check-in if no message yet.
+Use workout data for personalization.
+</task>
+
+""" + _USER_BASE_CONTEXT + """
+
+<first_workout_data>
+    <workout_name>{workout_name}</workout_name>
+    <date>{workout_date}</date>
+    <checked_in>{checked_in}</checked_in>
 
     <performance>
-      <calories>{training_data.get("calories", "N/A")} kcal</calories>
-      <max_heart_rate>{hr_data.get("max_hr", "N/A")} bpm</max_heart_rate>
-      <average_heart_rate>{hr_data.get("average_hr", "N/A")} bpm</average_heart_rate>
-      <tonnage>{training_data.get("tonnage", "N/A")} kg</tonnage>
+      <calories>{calories} kcal</calories>
+      <max_heart_rate>{max_hr} bpm</max_heart_rate>
+      <average_heart_rate>{average_hr} bpm</average_heart_rate>
+      <tonnage>{tonnage} kg</tonnage>
     </performance>
 
     <ratings>
-      <workout_rating>{event_rating.get("ratingByEvent", "N/A")}/10</workout_rating>
-      <workout_comment>{event_rating.get("commentByEvent", "No comment")}</workout_comment>
-      <trainer_rating>{event_rating.get("ratingByTrainer", "N/A")}/10</trainer_rating>
+      <workout_rating>{workout_rating}/10</workout_rating>
+      <workout_comment>{workout_comment}</workout_comment>
+      <trainer_rating>{trainer_rating}/10</trainer_rating>
     </ratings>
-  </first_workout_data>"""
-
-        return f"""<task>
-Athlete completed their first training. Respond to their message OR initiate check-in if no message yet.
-Use workout data for personalization.
-</task>
-
-{base_context}
-
-{training_context}
+  </first_workout_data>
 
 <instruction>
 Before responding:
@@ -398,12 +395,11 @@ Before responding:
 Always respond in Russian language.
 </instruction>"""
 
-    elif trigger_type == "no_activity":
-        return f"""<task>
+_USER_TEMPLATE_NO_ACTIVITY = """<task>
 Athlete hasn't trained recently. Check on them and help re-engage without pressure.
 </task>
 
-{base_context}
+""" + _USER_BASE_CONTEXT + """
 
 <instruction>
 Before responding:
@@ -416,21 +412,16 @@ Before responding:
 Always respond in Russian language.
 </instruction>"""
 
-    elif trigger_type == "finish_program":
-        # Extract progress data
-        total_trainings = training_data.get("trainingCount", 0)
-        total_calories = training_data.get("totalCalories", 0)
-        
-        return f"""<task>
+_USER_TEMPLATE_FINISH_PROGRAM = """<task>
 Athlete completed their trial program. Celebrate their achievement and guide toward Hero's Pass membership.
 </task>
 
-{base_context}
+""" + _USER_BASE_CONTEXT + """
 
 <progress_summary>
   <total_trainings>{total_trainings}</total_trainings>
   <total_calories>{total_calories:,} kcal</total_calories>
-  <avg_rating_event>{training_data.get("avgRatingByEvent", "N/A")}/10</avg_rating_event>
+  <avg_rating_event>{avg_rating_event}/10</avg_rating_event>
 </progress_summary>
 
 <instruction>
@@ -445,12 +436,11 @@ Before responding:
 Always respond in Russian language.
 </instruction>"""
 
-    elif trigger_type == "payment":
-        return f"""<task>
+_USER_TEMPLATE_PAYMENT = """<task>
 Handle payment-related inquiry. Help with pricing, installments, or purchase process.
 </task>
 
-{base_context}
+""" + _USER_BASE_CONTEXT + """
 
 <instruction>
 Before responding:
@@ -463,12 +453,11 @@ Before responding:
 Always respond in Russian language.
 </instruction>"""
 
-    else:  # default
-        return f"""<task>
+_USER_TEMPLATE_DEFAULT = """<task>
 General customer support. Help with their inquiry using available tools.
 </task>
 
-{base_context}
+""" + _USER_BASE_CONTEXT + """
 
 <instruction>
 Before responding:
@@ -481,10 +470,110 @@ Before responding:
 Always respond in Russian language.
 </instruction>"""
 
+_USER_TEMPLATES = {
+    "first_training": _USER_TEMPLATE_FIRST_TRAINING,
+    "no_activity": _USER_TEMPLATE_NO_ACTIVITY,
+    "finish_program": _USER_TEMPLATE_FINISH_PROGRAM,
+    "payment": _USER_TEMPLATE_PAYMENT,
+}
+
+# (placeholder, source key, default) triples, read in one pass per source dict
+_FIRST_TRAINING_FIELDS = (
+    ("workout_name", "eventName", "N/A"),
+    ("workout_date", "CheckedIndate", "N/A"),
+    ("checked_in", "hasCheckedIn", False),
+    ("calories", "calories", "N/A"),
+    ("tonnage", "tonnage", "N/A"),
+)
+_HEART_RATE_FIELDS = (
+    ("max_hr", "max_hr", "N/A"),
+    ("average_hr", "average_hr", "N/A"),
+)
+_EVENT_RATING_FIELDS = (
+    ("workout_rating", "ratingByEvent", "N/A"),
+    ("workout_comment", "commentByEvent", "No comment"),
+    ("trainer_rating", "ratingByTrainer", "N/A"),
+)
+_FINISH_PROGRAM_FIELDS = (
+    ("total_trainings", "trainingCount", 0),
+    ("total_calories", "totalCalories", 0),
+    ("avg_rating_event", "avgRatingByEvent", "N/A"),
+)
+
+# Per trigger: (training_data section or None for the top level, fields)
+_TRAINING_FIELDS_BY_TRIGGER = {
+    "first_training": (
+        (None, _FIRST_TRAINING_FIELDS),
+        ("heartRateData", _HEART_RATE_FIELDS),
+        ("eventRating", _EVENT_RATING_FIELDS),
+    ),
+    "finish_program": (
+        (None, _FINISH_PROGRAM_FIELDS),
+    ),
+}
+
+
+def _extract_fields(values: dict, source: dict, fields: tuple) -> None:
+    get = source.get
+    for name, key, default in fields:
+        values[name] = get(key, default)
+
+
+def format_history(dialog: list[dict]) -> str:
+    """
+    Render the last HISTORY_LIMIT dialog messages for the user prompt.
+    
+    Called once when fermer data is fetched; the result is kept in graph
+    state as history_text, so prompt builds only interpolate it.
+    """
+    return "\n".join(
+        f"{msg.get('sender', '')} ({msg.get('created_at', '')}): {msg.get('text', '')}"
+        for msg in islice(dialog, max(0, len(dialog) - HISTORY_LIMIT), None)
+    )
+
+
+def get_user_prompt(
+    trigger_type: str,
+    message: str,
+    history_text: str,
+    training_data: dict,
+    user_data: dict,
+) -> str:
+    """
+    Get user prompt based on trigger type and context.
+    
+    Args:
+        trigger_type: first_training, no_activity, finish_program, payment, default
+        message: Current user message
+        history_text: Conversation history rendered by format_history
+        training_data: Training performance data
+        user_data: User profile data
+    
+    Returns:
+        User prompt string
+    """
+    values = {
+        "message": message or "NO MESSAGE — initiate proactive check-in",
+        "user_name": user_data.get("firstName", "Клиент"),
+        "user_sex": user_data.get("sex", "Not specified"),
+        "club_name": user_data.get("club", {}).get("name", "Not specified"),
+        "history_text": history_text or "NO PREVIOUS CONVERSATION",
+        "current_time": _cached_current_time(),
+    }
+    
+    # Extract training performance / progress data the trigger's template needs
+    for section, fields in _TRAINING_FIELDS_BY_TRIGGER.get(trigger_type, ()):
+        source = training_data.get(section, {}) if section else training_data
+        _extract_fields(values, source, fields)
+    
+    return _USER_TEMPLATES.get(trigger_type, _USER_TEMPLATE_DEFAULT).format_map(values)
+
 
 # ============== EXPORT ==============
 
 __all__ = [
     "get_system_prompt",
     "get_user_prompt",
+    "format_history",
+    "HISTORY_LIMIT",
 ]
@@ -6,14 +6,20 @@ FastAPI server exposing the LangGraph workflow via HTTP.
 Replaces n8n webhook trigger with FastAPI endpoint.
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from contextlib import asynccontextmanager
+from typing import Optional, TypeVar
+import asyncio
 import uvicorn
 import logging
+import os
 
 from graph import process_message, fermer_graph
+from integrations import close_http_clients
+from tools import close_http_client
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,8 +28,15 @@ logger = logging.getLogger(__name__)
 
 # ============== API MODELS ==============
 
+# Request payloads are read-only; Wazzup sends many fields we don't use,
+# which are dropped without being stored
+REQUEST_MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True)
+
+
 class WazzupMessage(BaseModel):
     """Wazzup webhook message format."""
+    model_config = REQUEST_MODEL_CONFIG
+    
     chatId: str
     channelId: str
     text: Optional[str] = None
@@ -34,11 +47,15 @@ class WazzupMessage(BaseModel):
 
 class WazzupWebhook(BaseModel):
     """Wazzup webhook payload format."""
+    model_config = REQUEST_MODEL_CONFIG
+    
     messages: list[WazzupMessage]
 
 
 class ChatflowMessage(BaseModel):
     """Alternative message format from chatflow."""
+    model_config = REQUEST_MODEL_CONFIG
+    
     chatId: str
     channelId: str
     msg: str
@@ -50,6 +67,8 @@ class ChatflowMessage(BaseModel):
 
 class ProcessRequest(BaseModel):
     """Direct message processing request."""
+    model_config = REQUEST_MODEL_CONFIG
+    
     chat_id: str = Field(..., description="User's chat ID")
     sender_id: str = Field(..., description="Sender identifier")
     message: str = Field(..., description="Message text")
@@ -65,12 +84,115 @@ class ProcessResponse(BaseModel):
     error: Optional[str] = None
 
 
+# Wazzup also posts delivery receipts and outbound echoes; the reply to
+# those never changes, so its JSON is rendered once
+NOT_INBOUND_RESPONSE_BODY = ProcessResponse(
+    response_text="",
+    escalation_needed=False,
+    error="Not an inbound message",
+).model_dump_json().encode()
+
+
+# ============== IN-FLIGHT DEDUPLICATION ==============
+
+# A burst of webhooks for one chat must not run the agent twice for the same
+# text, nor run different messages concurrently on the same checkpoint thread
+_inflight: dict[tuple[str, str], asyncio.Task] = {}
+_chat_locks: dict[str, asyncio.Lock] = {}
+_chat_lock_users: dict[str, int] = {}
+
+
+async def process_message_once(chat_id: str, message: str, **kwargs) -> dict:
+    """
+    process_message with per-chat coalescing.
+    
+    A request whose (chat_id, message) is already being processed awaits
+    that run's result instead of starting another one. Different messages
+    of the same chat are processed one after another, in arrival order.
+    """
+    key = (chat_id, message)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_process_in_chat_order(chat_id, message, **kwargs))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    
+    # Shielded: a disconnecting caller must not cancel the run for the others
+    return await asyncio.shield(task)
+
+
+async def _process_in_chat_order(chat_id: str, message: str, **kwargs) -> dict:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    _chat_lock_users[chat_id] = _chat_lock_users.get(chat_id, 0) + 1
+    
+    try:
+        async with lock:
+            return await process_message(chat_id=chat_id, message=message, **kwargs)
+    finally:
+        _chat_lock_users[chat_id] -= 1
+        if not _chat_lock_users[chat_id]:
+            del _chat_lock_users[chat_id]
+            del _chat_locks[chat_id]
+
+
+# ============== WEBHOOK BODIES ==============
+
+# Webhook bodies are validated straight from the raw bytes by pydantic-core
+# (model_validate_json) instead of FastAPI's json.loads + model_validate.
+# The endpoints take the Request, so the body schema is declared explicitly.
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+async def parse_body(request: Request, model: type[ModelT]) -> ModelT:
+    """Validate the request body as `model`; errors become the usual 422."""
+    try:
+        return model.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])}
+            for error in e.errors(include_url=False)
+        ])
+
+
+def body_schema(model: type[BaseModel]) -> dict:
+    """openapi_extra declaring `model` as the JSON request body."""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+    
+    def inline(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref", "")
+            if ref.startswith("#/$defs/"):
+                return inline(defs[ref.removeprefix("#/$defs/")])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(item) for item in node]
+        return node
+    
+    return {"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": inline(schema)}},
+    }}
+
+
 # ============== APP SETUP ==============
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Close shared outbound HTTP connections on shutdown."""
+    yield
+    await close_http_clients()
+    await close_http_client()
+
+
 app = FastAPI(
     title="Fermer Agent API",
     description="LangGraph-based AI agent for Hero's Journey customer support",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -84,65 +206,92 @@ app.add_middleware(
 
 # ============== ENDPOINTS ==============
 
+# Every endpoint declares a response model or return type: FastAPI then
+# serializes straight to JSON bytes with pydantic-core instead of going
+# through jsonable_encoder + json.dumps.
+
 @app.get("/health")
-async def health_check():
+async def health_check() -> dict:
     """Health check endpoint."""
     return {"status": "healthy", "service": "fermer-agent"}
 
 
-@app.post("/webhook/wazzup", response_model=ProcessResponse)
-async def wazzup_webhook(payload: WazzupWebhook, background_tasks: BackgroundTasks):
+@app.post(
+    "/webhook/wazzup",
+    response_model=ProcessResponse,
+    openapi_extra=body_schema(WazzupWebhook),
+)
+async def wazzup_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Wazzup webhook endpoint.
     
-    Receives messages from Wazzup and processes them through the agent.
+    Receives messages from Wazzup and processes them through the agent in
+    the background; replies are sent by the graph, not in this response.
     Equivalent to n8n "Webhook Wazzup staryi" trigger.
     """
+    payload = await parse_body(request, WazzupWebhook)
+    
     if not payload.messages:
         raise HTTPException(status_code=400, detail="No messages in payload")
     
-    message = payload.messages[0]
-    
     # Filter: only process inbound messages
-    if message.status != "inbound":
-        return ProcessResponse(
-            response_text="",
-            escalation_needed=False,
-            error="Not an inbound message"
-        )
+    inbound = [message for message in payload.messages if message.status == "inbound"]
+    if not inbound:
+        return Response(NOT_INBOUND_RESPONSE_BODY, media_type="application/json")
     
-    # Process message
-    try:
-        result = await process_message(
+    # A batch can hold several chats: chats run concurrently, while messages
+    # of one chat stay sequential since they share a conversation thread
+    by_chat: dict[str, list[WazzupMessage]] = {}
+    for message in inbound:
+        by_chat.setdefault(message.chatId, []).append(message)
+    
+    # ACK right away: the graph delivers the reply itself through the Wazzup
+    # API, and a slow ACK makes Wazzup retry the webhook (duplicate LLM runs)
+    background_tasks.add_task(_process_wazzup_batch, by_chat)
+    
+    return ProcessResponse(response_text="", escalation_needed=False)
+
+
+async def _process_wazzup_batch(by_chat: dict[str, list[WazzupMessage]]) -> None:
+    """Background part of wazzup_webhook; failures are logged per chat."""
+    chat_results = await asyncio.gather(
+        *(_process_wazzup_chat(messages) for messages in by_chat.values()),
+        return_exceptions=True,
+    )
+    
+    for chat_result in chat_results:
+        if isinstance(chat_result, Exception):
+            logger.error("Error processing message: %s", chat_result)
+
+
+async def _process_wazzup_chat(messages: list[WazzupMessage]) -> None:
+    """Run one chat's messages from a Wazzup batch through the agent, in order."""
+    for message in messages:
+        await process_message_once(
             chat_id=message.chatId,
             sender_id=message.chatId,
             message=message.text or "",
             source=message.chatType,
             channel_id=message.channelId,
         )
-        
-        return ProcessResponse(
-            response_text=result.get("response_text", ""),
-            escalation_needed=result.get("escalation_needed", False),
-            escalation_reason=result.get("escalation_reason", ""),
-            error=result.get("error"),
-        )
-        
-    except Exception as e:
-        logger.exception(f"Error processing message: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/webhook/chatflow", response_model=ProcessResponse)
-async def chatflow_webhook(payload: ChatflowMessage):
+@app.post(
+    "/webhook/chatflow",
+    response_model=ProcessResponse,
+    openapi_extra=body_schema(ChatflowMessage),
+)
+async def chatflow_webhook(request: Request):
     """
     Chatflow webhook endpoint.
     
     Alternative message format from chatflow system.
     Equivalent to n8n "data from chatflow" trigger.
     """
+    payload = await parse_body(request, ChatflowMessage)
+    
     try:
-        result = await process_message(
+        result = await process_message_once(
             chat_id=payload.chatId,
             sender_id=payload.chatId,
             message=payload.msg,
@@ -158,7 +307,7 @@ async def chatflow_webhook(payload: ChatflowMessage):
         )
         
     except Exception as e:
-        logger.exception(f"Error processing chatflow message: {e}")
+        logger.exception("Error processing chatflow message: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -170,7 +319,7 @@ async def process_direct(request: ProcessRequest):
     For testing or direct API integration.
     """
     try:
-        result = await process_message(
+        result = await process_message_once(
             chat_id=request.chat_id,
             sender_id=request.sender_id,
             message=request.message,
@@ -186,69 +335,84 @@ async def process_direct(request: ProcessRequest):
         )
         
     except Exception as e:
-        logger.exception(f"Error processing direct message: {e}")
+        logger.exception("Error processing direct message: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/graph/state/{chat_id}")
-async def get_graph_state(chat_id: str):
+async def get_graph_state(chat_id: str) -> dict:
     """
     Get current graph state for a chat.
     
     Useful for debugging and monitoring.
     """
+    if fermer_graph.checkpointer is None:
+        raise HTTPException(status_code=404, detail="Checkpointing is disabled")
+    
     try:
         config = {"configurable": {"thread_id": chat_id}}
-        state = await fermer_graph.aget_state(config)
+        # Read the raw checkpoint instead of rebuilding a full StateSnapshot
+        checkpoint_tuple = await fermer_graph.checkpointer.aget_tuple(config)
+        values = checkpoint_tuple.checkpoint["channel_values"] if checkpoint_tuple else {}
         
-        if state.values:
+        if values:
             return {
                 "chat_id": chat_id,
-                "trigger_type": state.values.get("trigger_type"),
-                "escalation_needed": state.values.get("escalation_needed"),
-                "last_response": state.values.get("humanized_response") or state.values.get("response_text"),
-                "error": state.values.get("error"),
+                "trigger_type": values.get("trigger_type"),
+                "escalation_needed": values.get("escalation_needed"),
+                "last_response": values.get("humanized_response") or values.get("response_text"),
+                "error": values.get("error"),
             }
         else:
             return {"chat_id": chat_id, "state": "not found"}
             
     except Exception as e:
-        logger.exception(f"Error getting state: {e}")
+        logger.exception("Error getting state: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/graph/history/{chat_id}")
-async def get_graph_history(chat_id: str, limit: int = 10):
+async def get_graph_history(chat_id: str, limit: int = 10) -> dict:
     """
     Get conversation history for a chat.
     """
+    if fermer_graph.checkpointer is None:
+        raise HTTPException(status_code=404, detail="Checkpointing is disabled")
+    
     try:
         config = {"configurable": {"thread_id": chat_id}}
         states = []
         
-        async for state in fermer_graph.aget_state_history(config):
+        # Let the checkpointer stop after `limit` rows and read raw channel
+        # values, instead of building a StateSnapshot per checkpoint
+        async for checkpoint_tuple in fermer_graph.checkpointer.alist(config, limit=limit):
+            values = checkpoint_tuple.checkpoint["channel_values"]
             states.append({
-                "trigger_type": state.values.get("trigger_type"),
-                "message": state.values.get("message"),
-                "response": state.values.get("humanized_response") or state.values.get("response_text"),
+                "trigger_type": values.get("trigger_type"),
+                "message": values.get("message"),
+                "response": values.get("humanized_response") or values.get("response_text"),
             })
-            if len(states) >= limit:
-                break
         
         return {"chat_id": chat_id, "history": states}
         
     except Exception as e:
-        logger.exception(f"Error getting history: {e}")
+        logger.exception("Error getting history: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # ============== MAIN ==============
 
 if __name__ == "__main__":
+    # DEV=1 enables auto-reload and info logs. Otherwise run on uvloop +
+    # httptools. Stays single-process: caches, in-flight coalescing and the
+    # memory checkpointer all live in this process.
+    dev = os.getenv("DEV") == "1"
     uvicorn.run(
         "server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info",
+        reload=dev,
+        loop="uvloop",
+        http="httptools",
+        log_level="info" if dev else "warning",
     )
@@ -16,36 +16,80 @@ from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.messages import HumanMessage
 from pinecone import Pinecone
 from typing import Optional, Literal
-from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import groupby, islice
+from operator import attrgetter, mul
+from types import MappingProxyType
+import asyncio
+import base64
 import httpx
+import orjson
 import os
+import random
 import re
+import time
 
+from integrations import (
+    RETRY_ATTEMPTS,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    RETRY_STATUSES,
+    TTLCache,
+    invalidate_cached,
+    request,
+)
 
-# ============== CONSTANTS ==============
 
-GRAPHQL_ENDPOINT = "https://admin.herosjourney.kz/graphql"
-AUTH_TOKEN = os.getenv("HJ_AUTH_TOKEN")
+# ============== CONSTANTS ==============
 
-CLUB_NAMES = {
+CLUB_NAMES = MappingProxyType({
     "6788b54527af6c00ab78c66a": "Europe City",
     "67d7c4cc8b5b3112cb0bcd44": "Promenade",
     "6351ace4d61faf000b2febc8": "Nurly Orda",
     "65e9e70cbd4814536c5e27e9": "Colibri",
     "683704d8c85fb0a6b1f5a8ca": "Villa",
     "68a45233d9ba5a6ba953e5f0": "4YOU",
-}
+})
 
-CLUB_IDS_BY_NAME = {v.lower(): k for k, v in CLUB_NAMES.items()}
-CLUB_IDS_BY_NAME.update({
-    "колибри": "65e9e70cbd4814536c5e27e9",
-    "променад": "67d7c4cc8b5b3112cb0bcd44",
-    "вилла": "683704d8c85fb0a6b1f5a8ca",
-    "европа сити": "6788b54527af6c00ab78c66a",
-    "нурлы орда": "6351ace4d61faf000b2febc8",
-    "4ю": "68a45233d9ba5a6ba953e5f0",
+# Read-only, keys casefolded once at import
+CLUB_IDS_BY_NAME = MappingProxyType({
+    name.casefold(): club_id
+    for name, club_id in (
+        *((v, k) for k, v in CLUB_NAMES.items()),
+        ("Колибри", "65e9e70cbd4814536c5e27e9"),
+        ("Променад", "67d7c4cc8b5b3112cb0bcd44"),
+        ("Вилла", "683704d8c85fb0a6b1f5a8ca"),
+        ("Европа Сити", "6788b54527af6c00ab78c66a"),
+        ("Нурлы Орда", "6351ace4d61faf000b2febc8"),
+        ("4Ю", "68a45233d9ba5a6ba953e5f0"),
+    )
 })
 
+# Spaces, dashes, underscores and punctuation are ignored when matching names
+_CLUB_NAME_NOISE = re.compile(r"[\s\-_.,!?]+")
+
+
+def _club_key(value: str) -> str:
+    """Normalized form of a club ID or name ("Europe-City " → "europecity")."""
+    return _CLUB_NAME_NOISE.sub("", value).casefold()
+
+
+# IDs and names (Latin and Russian), normalized: one lookup resolves either
+_CLUB_LOOKUP = {
+    **{club_id: club_id for club_id in CLUB_NAMES},
+    **{_club_key(name): club_id for name, club_id in CLUB_IDS_BY_NAME.items()},
+}
+
+# Any club name inside free text ("расписание в Променаде"), longest names first
+_CLUB_NAME_PATTERN = re.compile("|".join(
+    re.escape(key) for key in sorted(map(_club_key, CLUB_IDS_BY_NAME), key=len, reverse=True)
+))
+
 TRAINING_TYPES = {
     "strength": {"keywords": ["RT"], "label": "силовые"},
     "bootcamp": {"keywords": ["Bootcamp"], "label": "Bootcamp"},
@@ -60,6 +104,20 @@ TRAINING_TYPES = {
     "arm": {"keywords": ["Arm"], "label": "Arm"},
 }
 
+
+def _keyword_matcher(keywords: list[str]):
+    """Predicate telling whether a program name contains any of the keywords."""
+    if len(keywords) == 1:
+        keyword = keywords[0]
+        return lambda name: keyword in name
+    # One regex scan over the name instead of a substring search per keyword
+    return re.compile("|".join(map(re.escape, keywords))).search
+
+
+# Built once at import, per training type
+for _training_type in TRAINING_TYPES.values():
+    _training_type["matcher"] = _keyword_matcher(_training_type["keywords"])
+
 WEEKDAYS = {
     "monday": {"index": 0, "label": "понедельник"},
     "tuesday": {"index": 1, "label": "вторник"},
@@ -81,11 +139,103 @@ TIME_OF_DAY = {
     "evening": {"start": 18, "end": 23, "label": "вечер"},
 }
 
-TIMEZONE_OFFSET = timedelta(hours=5)  # Almaty timezone
+TIMEZONE = ZoneInfo("Asia/Almaty")
+
+
+# ============== HTTP CLIENT ==============
+
+# Shared by tools calling third-party hosts (Google Docs): keep-alive
+# connections are reused across tool calls instead of a new TCP + TLS
+# handshake per call. HTTP/2 lets concurrent tool calls to the same host
+# (the agent runs them with gather) share one connection.
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Lazy initialization of the shared HTTP client."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=300,
+            ),
+        )
+    return _http_client
+
+
+async def _retry_backoff(attempt: int) -> None:
+    """Sleep before the next attempt: the integrations jittered exponential backoff."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    await asyncio.sleep(random.uniform(0, delay))
+
+
+async def _get_with_retry(url: str) -> httpx.Response:
+    """
+    GET a third-party URL on the shared client, retrying transport errors and
+    RETRY_STATUSES with the same jittered exponential backoff as integrations.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        last_attempt = attempt == RETRY_ATTEMPTS - 1
+        try:
+            response = await _get_http_client().get(url, follow_redirects=True)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+        
+        await _retry_backoff(attempt)
+
+
+async def _backend_post(path: str, payload: dict, *, idempotent: bool = True) -> dict:
+    """
+    POST a JSON payload to the Hero's Journey backend and decode the reply.
+    
+    Goes through the integrations "graphql" client, so transient failures are
+    retried with backoff and calls fail fast with CircuitOpenError while the
+    backend's circuit breaker is open, instead of each waiting out a timeout.
+    """
+    response = await request("graphql", "POST", path, idempotent=idempotent, content=orjson.dumps(payload))
+    return orjson.loads(response.content)
+
+
+async def close_http_client() -> None:
+    """Close the shared tools HTTP client (called from the FastAPI lifespan)."""
+    global _http_client
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
 
 
 # ============== SCHEDULE TOOL ==============
 
+# Events per (club_id, window): consecutive turns of a conversation
+# usually ask about the same club and days with different filters
+SCHEDULE_CACHE_TTL = 60
+SCHEDULE_CACHE_SIZE = 256
+
+SCHEDULE_QUERY = """
+query EventsByDates($startTime: String!, $endTime: String!, $clubId: String!) {
+    eventsByDates(startTime: $startTime, endTime: $endTime, clubId: $clubId) {
+        id
+        startTime
+        endTime
+        status
+        programSet {
+            name
+        }
+    }
+}
+"""
+
+_schedule_cache = TTLCache(SCHEDULE_CACHE_TTL, max_size=SCHEDULE_CACHE_SIZE)
+
+
 @tool
 async def get_schedule_by_club(
     club_id: str,
@@ -121,113 +271,42 @@ async def get_schedule_by_club(
     
     5. preferred_time (опционально): morning/afternoon/evening
     """
-    # Validate club_id
+    # Validate club_id (an ID or a club name in any case)
+    club_id = _resolve_club_id(club_id)
     club_name = CLUB_NAMES.get(club_id)
-    if not club_name:
-        # Try to resolve by name
-        club_id = CLUB_IDS_BY_NAME.get(club_id.lower())
-        club_name = CLUB_NAMES.get(club_id) if club_id else None
-        
+    
     if not club_name:
         available = ", ".join(CLUB_NAMES.values())
         return f"❌ Укажите клуб. Доступные: {available}"
     
-    # Calculate date range
-    now = datetime.utcnow() + TIMEZONE_OFFSET
-    
-    # Get week range (Monday to Sunday)
-    days_since_monday = now.weekday()
-    monday = now - timedelta(days=days_since_monday)
-    monday = monday.replace(hour=0, minute=0, second=0, microsecond=0)
-    sunday = monday + timedelta(days=6, hours=23, minutes=59, seconds=59)
-    
-    # Convert back to UTC for API
-    start_time = (monday - TIMEZONE_OFFSET).isoformat() + "Z"
-    end_time = (sunday - TIMEZONE_OFFSET).isoformat() + "Z"
-    
-    # GraphQL query
-    query = """
-    query EventsByDates($startTime: String!, $endTime: String!, $clubId: String!) {
-        eventsByDates(startTime: $startTime, endTime: $endTime, clubId: $clubId) {
-            id
-            startTime
-            endTime
-            status
-            programSet {
-                name
-            }
-        }
-    }
-    """
+    # Fetch only the days asked for
+    target_day = None
+    if day_of_week and day_of_week.lower() in WEEKDAYS:
+        target_day = WEEKDAYS[day_of_week.lower()]["index"]
+    today = datetime.now(TIMEZONE).date()
+    first_day, last_moment = _schedule_window(today, target_day, period)
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                GRAPHQL_ENDPOINT,
-                json={
-                    "query": query,
-                    "variables": {
-                        "startTime": start_time,
-                        "endTime": end_time,
-                        "clubId": club_id,
-                    }
-                },
-                headers={
-                    "Authorization": f"Bearer {AUTH_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            data = response.json()
+        trainings = await _get_events(club_id, first_day, last_moment)
     except Exception as e:
         return f"⚠️ Ошибка получения расписания: {str(e)}"
     
-    events = data.get("data", {}).get("eventsByDates", [])
-    if not events:
+    if not trainings:
         return f"📅 В {club_name} нет запланированных тренировок."
     
-    # Filter by status
-    trainings = [
-        e for e in events
-        if e.get("status") != "finished"
-        and "[TEST]" not in (e.get("programSet", {}).get("name") or "")
-    ]
-    
-    # Filter by period/day
-    if day_of_week and day_of_week.lower() in WEEKDAYS:
-        target_day = WEEKDAYS[day_of_week.lower()]["index"]
-        trainings = [
-            t for t in trainings
-            if _parse_datetime(t["startTime"]).weekday() == target_day
-        ]
-    elif period == "today":
-        today = now.date()
-        trainings = [
-            t for t in trainings
-            if _parse_datetime(t["startTime"]).date() == today
-        ]
-    elif period == "tomorrow":
-        tomorrow = (now + timedelta(days=1)).date()
-        trainings = [
-            t for t in trainings
-            if _parse_datetime(t["startTime"]).date() == tomorrow
-        ]
-    
-    # Filter by training type
+    # Resolve the filters once, then apply them all in a single pass
+    matches_type = time_range = None
     if training_type and training_type in TRAINING_TYPES:
-        keywords = TRAINING_TYPES[training_type]["keywords"]
-        trainings = [
-            t for t in trainings
-            if any(kw in (t.get("programSet", {}).get("name") or "") for kw in keywords)
-        ]
+        matches_type = TRAINING_TYPES[training_type]["matcher"]
     
-    # Filter by time of day
     if preferred_time and preferred_time in TIME_OF_DAY:
         time_range = TIME_OF_DAY[preferred_time]
-        trainings = [
-            t for t in trainings
-            if time_range["start"] <= _parse_datetime(t["startTime"]).hour < time_range["end"]
-        ]
+    
+    trainings = [
+        t for t in trainings
+        if (matches_type is None or matches_type(t.name))
+        and (time_range is None or time_range["start"] <= t.dt.hour < time_range["end"])
+    ]
     
     if not trainings:
         filter_desc = _build_filter_description(period, day_of_week, training_type, preferred_time)
@@ -237,10 +316,88 @@ async def get_schedule_by_club(
     return _format_schedule(trainings, club_name, club_id, period, day_of_week, training_type, preferred_time)
 
 
+@lru_cache(maxsize=64)
+def _schedule_window(today: date, target_day: Optional[int], period: Optional[str]) -> tuple[datetime, datetime]:
+    """
+    Local (start, end) of the days to fetch: the next occurrence of
+    target_day (today included), today, tomorrow, or else the current week
+    (Monday to Sunday). Memoized, since the answer only changes daily.
+    """
+    start = datetime(today.year, today.month, today.day, tzinfo=TIMEZONE)
+    if target_day is not None:
+        start += timedelta(days=(target_day - today.weekday()) % 7)
+        days = 1
+    elif period == "today":
+        days = 1
+    elif period == "tomorrow":
+        start += timedelta(days=1)
+        days = 1
+    else:
+        start -= timedelta(days=today.weekday())
+        days = 7
+    return start, start + timedelta(days=days, seconds=-1)
+
+
+def _resolve_club_id(value: str) -> str:
+    """
+    Club ID for an ID or name, tolerating case, spaces, dashes and
+    punctuation, or for text that mentions a club name.
+    """
+    key = _club_key(value)
+    club_id = _CLUB_LOOKUP.get(key)
+    if club_id is None:
+        match = _CLUB_NAME_PATTERN.search(key)
+        club_id = _CLUB_LOOKUP[match.group()] if match else value
+    return club_id
+
+
+@dataclass(slots=True, frozen=True)
+class _Event:
+    """A bookable schedule event, parsed once from the GraphQL payload."""
+    id: str
+    dt: datetime  # local start time
+    name: str  # program name, "" if missing
+
+
+async def _get_events(club_id: str, start: datetime, end: datetime) -> list[_Event]:
+    """
+    Bookable events of the club between local times start and end (finished
+    and [TEST] ones removed) in chronological order, cached for
+    SCHEDULE_CACHE_TTL seconds. Fetch errors are not cached.
+    """
+    async def fetch() -> list[_Event]:
+        # Convert back to UTC for API
+        start_time = start.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + "Z"
+        end_time = end.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + "Z"
+        
+        data = await _backend_post("/graphql", {
+            "query": SCHEDULE_QUERY,
+            "variables": {
+                "startTime": start_time,
+                "endTime": end_time,
+                "clubId": club_id,
+            }
+        })
+        
+        # One pass over the payload; filters and the formatter only touch _Event attributes
+        events = []
+        for e in data.get("data", {}).get("eventsByDates", []):
+            name = (e.get("programSet") or {}).get("name") or ""
+            if e.get("status") == "finished" or "[TEST]" in name:
+                continue
+            events.append(_Event(e["id"], _parse_datetime(e["startTime"]), name))
+        events.sort(key=attrgetter("dt"))
+        return events
+    
+    return await _schedule_cache.get_or_fetch((club_id, start.isoformat(), end.isoformat()), fetch)
+
+
 def _parse_datetime(iso_string: str) -> datetime:
-    """Parse ISO datetime string and convert to local time."""
-    dt = datetime.fromisoformat(iso_string.replace("Z", "+00:00"))
-    return dt.replace(tzinfo=None) + TIMEZONE_OFFSET
+    """Parse ISO datetime string (UTC unless it says otherwise) and convert to local time."""
+    dt = datetime.fromisoformat(iso_string)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(TIMEZONE)
 
 
 def _build_filter_description(period, day_of_week, training_type, preferred_time) -> str:
@@ -269,56 +426,49 @@ def _format_schedule(trainings, club_name, club_id, period, day_of_week, trainin
     """Format schedule for display."""
     filter_desc = _build_filter_description(period, day_of_week, training_type, preferred_time)
     
-    # Group by date
-    by_date = {}
-    for t in trainings:
-        dt = _parse_datetime(t["startTime"])
-        date_key = dt.strftime("%Y-%m-%d")
-        if date_key not in by_date:
-            by_date[date_key] = {
-                "display": _format_date(dt),
-                "trainings": [],
-            }
-        by_date[date_key]["trainings"].append({
-            "time": dt.strftime("%H:%M"),
-            "name": t.get("programSet", {}).get("name") or "Тренировка",
-            "id": t["id"],
-            "dt": dt,
-        })
-    
-    # Sort
-    sorted_dates = sorted(by_date.keys())
-    
     lines = [f"📅 {club_name} {filter_desc}:\n"]
     
-    for date_key in sorted_dates:
-        day = by_date[date_key]
-        day["trainings"].sort(key=lambda x: x["dt"])
-        
-        lines.append(f"\n📆 {day['display']}")
-        
-        for t in day["trainings"]:
-            lines.append(f"  🕐 {t['time']} | {t['name']} [id:{t['id']}]")
+    # Trainings are chronological, so each day's trainings are consecutive
+    for day_date, day in groupby(trainings, key=lambda t: t.dt.date()):
+        lines.append(f"\n📆 {_format_date(day_date)}")
+        lines.extend(
+            f"  🕐 {t.dt.hour:02d}:{t.dt.minute:02d} | {t.name or 'Тренировка'} [id:{t.id}]"
+            for t in day
+        )
     
     lines.append(f"\n📋 Для записи: используй eventId из [id:...] и clubId: {club_id}")
     
     return "\n".join(lines)
 
 
-def _format_date(dt: datetime) -> str:
+_DAYS_RU = ('понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье')
+_MONTHS_RU = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+              'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+
+
+def _format_date(dt: date) -> str:
     """Format date in Russian."""
-    days = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье']
-    months = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
-              'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
-    return f"{days[dt.weekday()]}, {dt.day} {months[dt.month - 1]}"
+    return f"{_DAYS_RU[dt.weekday()]}, {dt.day} {_MONTHS_RU[dt.month - 1]}"
 
 
 # ============== KNOWLEDGE BASE TOOL (Pinecone RAG) ==============
 
+KB_CACHE_SIZE = 256
+KB_CACHE_TTL = 300  # seconds a formatted search result is reused
+KB_SCORE_THRESHOLD = 0.7  # matches at or below this are not relevant enough
+KB_SIMILAR_QUERY_THRESHOLD = 0.97  # cosine similarity to reuse another query's result
+KB_SIMILAR_QUERY_SCAN = 64  # most recent results compared against a new query
+
 # Lazy initialization for Pinecone and embeddings
 _pc = None
+_index = None
 _embeddings = None
 
+# Keyed by the normalized query text, least recently used first
+_embed_cache: OrderedDict[str, list[float]] = OrderedDict()
+# Results keep an int8-quantized query embedding (see _quantize) for the similarity scan
+_kb_result_cache: OrderedDict[str, tuple[float, tuple[array, float], str]] = OrderedDict()
+
 
 def _get_pinecone():
     """Lazy initialization of Pinecone client."""
@@ -331,6 +481,14 @@ def _get_pinecone():
     return _pc
 
 
+def _get_pinecone_index():
+    """Lazy initialization of the knowledge base index handle."""
+    global _index
+    if _index is None:
+        _index = _get_pinecone().Index("fermer-knowledge")
+    return _index
+
+
 def _get_embeddings():
     """Lazy initialization of OpenAI embeddings."""
     global _embeddings
@@ -339,6 +497,60 @@ def _get_embeddings():
     return _embeddings
 
 
+def _lru_put(cache: OrderedDict, key: str, value) -> None:
+    """Store value as most recently used, evicting past KB_CACHE_SIZE."""
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > KB_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def _embed_query(key: str, query: str) -> list[float]:
+    """Embedding of the query, reused across searches with the same normalized key."""
+    embedding = _embed_cache.get(key)
+    if embedding is None:
+        embedding = await _get_embeddings().aembed_query(query)
+        _lru_put(_embed_cache, key, embedding)
+    else:
+        _embed_cache.move_to_end(key)
+    return embedding
+
+
+def _quantize(embedding: list[float]) -> tuple[array, float]:
+    """
+    int8 copy of an embedding and the scale that restores it.
+    
+    A 3072-dim vector shrinks from ~100 KB of Python floats to 3 KB, and the
+    rounding error is far below what the 0.97 similarity cutoff can notice.
+    """
+    scale = (max(map(abs, embedding)) or 1.0) / 127
+    return array("b", [round(x / scale) for x in embedding]), scale
+
+
+def _similar_query_result(embedding: list[float]) -> Optional[str]:
+    """
+    Fresh cached result of a recent query whose embedding is nearly the same.
+    
+    OpenAI embeddings are unit length, so the dot product is the cosine
+    similarity. Only the KB_SIMILAR_QUERY_SCAN most recent results are
+    compared to keep the scan cheap next to a Pinecone round-trip.
+    """
+    codes, scale = _quantize(embedding)
+    now = time.monotonic()
+    for stored_at, (cached_codes, cached_scale), result in islice(reversed(_kb_result_cache.values()), KB_SIMILAR_QUERY_SCAN):
+        if now - stored_at >= KB_CACHE_TTL:
+            continue
+        if sum(map(mul, codes, cached_codes)) * scale * cached_scale >= KB_SIMILAR_QUERY_THRESHOLD:
+            return result
+    return None
+
+
+def _clear_kb_cache() -> None:
+    """Drop cached query embeddings and results (e.g. after reindexing)."""
+    _embed_cache.clear()
+    _kb_result_cache.clear()
+
+
 @tool
 async def search_knowledge_base(query: str) -> str:
     """
@@ -381,39 +593,45 @@ async def search_knowledge_base(query: str) -> str:
     Returns:
         Релевантные документы из базы знаний
     """
+    key = " ".join(query.casefold().split())
+    cached = _kb_result_cache.get(key)
+    if cached and time.monotonic() - cached[0] < KB_CACHE_TTL:
+        _kb_result_cache.move_to_end(key)
+        return cached[2]
+    
     try:
-        pc = _get_pinecone()
-        embeddings = _get_embeddings()
-        index = pc.Index("fermer-knowledge")
-
         # Get embedding for query
-        query_embedding = await embeddings.aembed_query(query)
+        query_embedding = await _embed_query(key, query)
         
-        # Search Pinecone
-        results = index.query(
+        # A rephrasing of a recent question gets that question's result
+        similar = _similar_query_result(query_embedding)
+        if similar is not None:
+            return similar
+        
+        # Search Pinecone; the client is synchronous, so keep it off the event loop
+        results = await asyncio.to_thread(
+            _get_pinecone_index().query,
             vector=query_embedding,
             top_k=5,
             namespace="knowledge_base",
             include_metadata=True,
         )
         
-        if not results.matches:
-            return "Информация не найдена в базе знаний. Попробуйте другой запрос."
-        
-        # Format results
-        docs = []
-        for match in results.matches:
-            score = match.score
-            text = match.metadata.get("text", "")
-            source = match.metadata.get("source", "")
-            
-            if score > 0.7:  # Only include relevant results
-                docs.append(f"[Релевантность: {score:.0%}]\n{text}")
-        
-        if not docs:
-            return "Релевантных документов не найдено. Попробуйте уточнить запрос."
+        # Matches come back best first, so a weak top hit means nothing qualifies
+        matches = results.matches
+        if not matches:
+            result = "Информация не найдена в базе знаний. Попробуйте другой запрос."
+        elif matches[0].score <= KB_SCORE_THRESHOLD:
+            result = "Релевантных документов не найдено. Попробуйте уточнить запрос."
+        else:
+            result = "\n\n---\n\n".join(
+                f"[Релевантность: {round(match.score * 100)}%]\n{match.metadata.get('text', '')}"
+                for match in matches
+                if match.score > KB_SCORE_THRESHOLD
+            )
         
-        return "\n\n---\n\n".join(docs)
+        _lru_put(_kb_result_cache, key, (time.monotonic(), _quantize(query_embedding), result))
+        return result
         
     except Exception as e:
         return f"Ошибка поиска в базе знаний: {str(e)}"
@@ -421,6 +639,16 @@ async def search_knowledge_base(query: str) -> str:
 
 # ============== PAYMENT LINK TOOL ==============
 
+# Read-only: shared by every call
+PRODUCT_CONFIGS = MappingProxyType({
+    "heros_week": {"name": "Hero's Week", "price": 9990},
+    "basecamp": {"name": "Basecamp", "price": 29990},
+    "first_step": {"name": "Первый Шаг", "price": 59990},
+    "heros_pass_6": {"name": "Hero's Pass 6 мес", "price": 349990},
+    "heros_pass_12": {"name": "Hero's Pass 12 мес", "price": 549990},
+})
+
+
 @tool
 async def get_payment_link(
     product: Literal["heros_week", "basecamp", "first_step", "heros_pass_6", "heros_pass_12"],
@@ -445,37 +673,20 @@ async def get_payment_link(
     Returns:
         Ссылка на оплату или сообщение об ошибке
     """
-    PRODUCT_CONFIGS = {
-        "heros_week": {"name": "Hero's Week", "price": 9990},
-        "basecamp": {"name": "Basecamp", "price": 29990},
-        "first_step": {"name": "Первый Шаг", "price": 59990},
-        "heros_pass_6": {"name": "Hero's Pass 6 мес", "price": 349990},
-        "heros_pass_12": {"name": "Hero's Pass 12 мес", "price": 549990},
-    }
-    
     if product not in PRODUCT_CONFIGS:
         return f"❌ Неизвестный продукт. Доступные: {', '.join(PRODUCT_CONFIGS.keys())}"
     
     config = PRODUCT_CONFIGS[product]
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{GRAPHQL_ENDPOINT}/payment/create-link",
-                json={
-                    "product": product,
-                    "clubId": club_id,
-                    "chatId": chat_id,
-                    "amount": config["price"],
-                },
-                headers={
-                    "Authorization": f"Bearer {AUTH_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            data = response.json()
-            
+        # Creating a link is not idempotent: only retried if provably not processed
+        data = await _backend_post("/graphql/payment/create-link", {
+            "product": product,
+            "clubId": club_id,
+            "chatId": chat_id,
+            "amount": config["price"],
+        }, idempotent=False)
+        
         if "paymentUrl" in data:
             return f"✅ Ссылка на оплату {config['name']} ({config['price']:,} ₸):\n{data['paymentUrl']}"
         else:
@@ -498,8 +709,11 @@ GOOGLE_DOCS = {
     "membership_info": "18m2178NQ2CwDp1P3dJDI-BCAiWlu7I7BCd_3b7rYVFA",
 }
 
-# Cache for Google Docs content (avoid repeated API calls)
-_docs_cache = {}
+DOCS_CACHE_TTL = 6 * 3600  # seconds; edits to the docs show up within this
+
+# Cache for Google Docs content (avoid repeated API calls). Concurrent tool
+# calls for the same doc share one download.
+_docs_cache = TTLCache(DOCS_CACHE_TTL, max_size=32)
 
 
 async def _fetch_google_doc(doc_id: str) -> str:
@@ -507,25 +721,14 @@ async def _fetch_google_doc(doc_id: str) -> str:
     Fetch content from Google Docs.
     Uses export URL to get plain text without needing OAuth for public docs.
     """
-    if doc_id in _docs_cache:
-        return _docs_cache[doc_id]
-
-    export_url = f"https://docs.google.com/document/d/{doc_id}/export?format=txt"
+    async def download() -> str:
+        response = await _get_with_retry(f"https://docs.google.com/document/d/{doc_id}/export?format=txt")
+        if response.status_code != 200:
+            raise ValueError(f"HTTP {response.status_code}")
+        return response.text
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                export_url,
-                follow_redirects=True,
-                timeout=30.0,
-            )
-
-            if response.status_code == 200:
-                content = response.text
-                _docs_cache[doc_id] = content
-                return content
-            else:
-                return f"Ошибка загрузки документа: HTTP {response.status_code}"
+        return await _docs_cache.get_or_fetch(doc_id, download)
     except Exception as e:
         return f"Ошибка загрузки документа: {str(e)}"
 
@@ -658,8 +861,121 @@ async def get_membership_info() -> str:
     return await _fetch_google_doc(GOOGLE_DOCS["membership_info"])
 
 
+@tool
+async def get_docs_bundle(
+    topics: list[Literal[
+        "general_info", "social_features", "app_functionality", "workout_info",
+        "clan_battle_info", "workouts_descriptions", "membership_info",
+    ]],
+) -> str:
+    """
+    Get several Hero's Journey documents in one call.
+
+    Topics are the same documents as the single-topic tools:
+    general_info, social_features, app_functionality, workout_info,
+    clan_battle_info, workouts_descriptions, membership_info.
+
+    Use this tool instead of calling several single-topic tools when a
+    customer's question spans multiple topics, e.g.:
+    - Prices AND what the workouts are like
+    - Clans AND how the app works
+
+    Args:
+        topics: Documents to fetch
+
+    Returns:
+        Each document under its topic header
+    """
+    topics = list(dict.fromkeys(topics))
+    # Downloads run concurrently: the wait is the slowest doc, not the sum
+    contents = await asyncio.gather(*(_fetch_google_doc(GOOGLE_DOCS[topic]) for topic in topics))
+    return "\n\n".join(f"=== {topic} ===\n{content}" for topic, content in zip(topics, contents))
+
+
 # ============== IMAGE ANALYSIS TOOL ==============
 
+IMAGE_CACHE_TTL = 600  # seconds
+IMAGE_INLINE_MAX_BYTES = 4 * 1024 * 1024  # larger images are passed by URL
+# Media hosts of our chat channels (subdomains included). The image URL comes
+# from the model, i.e. from customer text: anything else is never fetched here
+IMAGE_HOSTS = ("wazzup24.com", "telegram.org")
+
+# Image URL → data: URL, so re-analyzing the same image skips the download
+_image_cache = TTLCache(IMAGE_CACHE_TTL, max_size=32)
+
+_vision_llm = None
+
+
+def _get_vision_llm():
+    """Lazy initialization of the vision model (reuses its OpenAI connection pool)."""
+    global _vision_llm
+    if _vision_llm is None:
+        _vision_llm = ChatOpenAI(model="gpt-4o", temperature=0.3)
+    return _vision_llm
+
+
+def _is_trusted_image_url(image_url: str) -> bool:
+    """True for https URLs on IMAGE_HOSTS."""
+    try:
+        url = httpx.URL(image_url)
+    except httpx.InvalidURL:
+        return False
+    host = url.host
+    return url.scheme == "https" and any(
+        host == domain or host.endswith("." + domain) for domain in IMAGE_HOSTS
+    )
+
+
+async def _image_data_url(image_url: str) -> str:
+    """
+    The image inlined as a base64 data: URL, so OpenAI doesn't have to fetch
+    it from the image host itself. Only https URLs on IMAGE_HOSTS are
+    downloaded, without following redirects. Falls back to the original URL
+    for other hosts, failed downloads, non-image responses and images over
+    IMAGE_INLINE_MAX_BYTES (the download is aborted once past the cap).
+    Transport errors and RETRY_STATUSES are retried like _get_with_retry.
+    """
+    if image_url.startswith("data:") or not _is_trusted_image_url(image_url):
+        return image_url
+
+    async def download() -> str:
+        for attempt in range(RETRY_ATTEMPTS):
+            last_attempt = attempt == RETRY_ATTEMPTS - 1
+            try:
+                return await download_once()
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRY_STATUSES or last_attempt:
+                    raise
+            
+            await _retry_backoff(attempt)
+
+    async def download_once() -> str:
+        async with _get_http_client().stream("GET", image_url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            if not content_type.startswith("image/"):
+                return image_url
+            declared = response.headers.get("content-length", "")
+            if declared.isdigit() and int(declared) > IMAGE_INLINE_MAX_BYTES:
+                return image_url
+            
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) > IMAGE_INLINE_MAX_BYTES:
+                    return image_url
+        
+        return f"data:{content_type};base64,{base64.b64encode(body).decode()}"
+
+    try:
+        return await _image_cache.get_or_fetch(image_url, download)
+    except Exception:
+        return image_url
+
+
 @tool
 async def analyze_image(image_url: str, question: Optional[str] = None) -> str:
     """
@@ -678,14 +994,14 @@ async def analyze_image(image_url: str, question: Optional[str] = None) -> str:
         Description or analysis of the image content
     """
     try:
-        llm = ChatOpenAI(model="gpt-4o", temperature=0.3)
+        llm = _get_vision_llm()
 
         prompt = question or "Опиши что на этом изображении. Если это связано с фитнесом или тренировками, дай соответствующий контекст."
 
         message = HumanMessage(
             content=[
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": image_url}},
+                {"type": "image_url", "image_url": {"url": await _image_data_url(image_url)}},
             ]
         )
 
@@ -698,6 +1014,18 @@ async def analyze_image(image_url: str, question: Optional[str] = None) -> str:
 
 # ============== USER PROFILE TOOL ==============
 
+UPDATE_PROFILE_MUTATION = """
+mutation UpdateUserProfile($chatId: String!, $field: String!, $value: String!) {
+    updateFermerProfile(
+        chatId: $chatId
+        updates: { field: $field, value: $value }
+    ) {
+        success
+    }
+}
+"""
+
+
 @tool
 async def update_user_profile(
     chat_id: str,
@@ -722,38 +1050,19 @@ async def update_user_profile(
     Returns:
         Confirmation message
     """
-    mutation = """
-    mutation UpdateUserProfile($chatId: String!, $field: String!, $value: String!) {
-        updateFermerProfile(
-            chatId: $chatId
-            updates: { field: $field, value: $value }
-        ) {
-            success
-        }
-    }
-    """
-
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                GRAPHQL_ENDPOINT,
-                json={
-                    "query": mutation,
-                    "variables": {
-                        "chatId": chat_id,
-                        "field": field,
-                        "value": value,
-                    }
-                },
-                headers={
-                    "Authorization": f"Bearer {AUTH_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            data = response.json()
+        data = await _backend_post("/graphql", {
+            "query": UPDATE_PROFILE_MUTATION,
+            "variables": {
+                "chatId": chat_id,
+                "field": field,
+                "value": value,
+            }
+        })
 
         if data.get("data", {}).get("updateFermerProfile", {}).get("success"):
+            # The next turn must build its prompt from the updated profile
+            invalidate_cached(chat_id)
             return f"✅ Профиль обновлен: {field} = {value}"
         else:
             return "Профиль не был обновлен"
@@ -777,7 +1086,10 @@ __all__ = [
     "get_clan_battle_info",
     "get_workouts_descriptions",
     "get_membership_info",
+    "get_docs_bundle",
     # Other tools
     "analyze_image",
     "update_user_profile",
+    # Lifecycle
+    "close_http_client",
 ]
@@ -1 +0,0 @@
-"""Tests package."""
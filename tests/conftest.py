@@ -0,0 +1,42 @@
+"""Shared pytest configuration."""
+
+import asyncio
+
+import pytest
+import uvloop
+
+# Mock environment before imports: the app modules read it at import time
+_env = pytest.MonkeyPatch()
+_env.setenv("OPENAI_API_KEY", "test-key")
+_env.setenv("HJ_AUTH_TOKEN", "test-token")
+_env.setenv("PINECONE_API_KEY", "test-pinecone")
+_env.setenv("WAZZUP_TOKEN", "test-wazzup")
+_env.setenv("TELEGRAM_BOT_TOKEN", "test-telegram")
+_env.setenv("AMOCRM_TOKEN", "test-amocrm")
+
+# Import the app once per session (and per xdist worker) before any test runs
+import src.graph  # noqa: E402,F401
+import src.integrations  # noqa: E402,F401
+import src.prompts  # noqa: E402,F401
+import src.tools  # noqa: E402,F401
+
+
+@pytest.fixture(autouse=True, scope="session")
+def mock_env():
+    yield
+    _env.undo()
+
+
+def _new_event_loop() -> asyncio.AbstractEventLoop:
+    loop = uvloop.new_event_loop()
+    # Python 3.12+: tasks whose mocked coroutines never suspend finish
+    # synchronously instead of taking a trip through the scheduler
+    eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_task_factory is not None:
+        loop.set_task_factory(eager_task_factory)
+    return loop
+
+
+def pytest_asyncio_loop_factories(config, item):
+    """Run async tests on uvloop, the loop the server uses in production."""
+    return {"uvloop": _new_event_loop}
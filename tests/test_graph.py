@@ -6,18 +6,66 @@ Basic tests for the LangGraph workflow.
 
 import pytest
 import asyncio
-from unittest.mock import AsyncMock, patch
+import httpx
+import orjson
+import time
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from unittest.mock import AsyncMock, MagicMock, patch
 
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 
-# Mock environment before imports
-@pytest.fixture(autouse=True)
-def mock_env(monkeypatch):
-    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
-    monkeypatch.setenv("HJ_AUTH_TOKEN", "test-token")
-    monkeypatch.setenv("PINECONE_API_KEY", "test-pinecone")
-    monkeypatch.setenv("WAZZUP_TOKEN", "test-wazzup")
-    monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "test-telegram")
-    monkeypatch.setenv("AMOCRM_TOKEN", "test-amocrm")
+
+from src import integrations, tools
+from src.graph import (
+    FermerState,
+    MAX_AGENT_MESSAGES,
+    TOOL_OUTPUT_TRIM_LENGTH,
+    TRIGGER_PRIORITY,
+    _parse_agent_output,
+    _trim_agent_messages,
+    ai_agent_node,
+    create_fermer_graph,
+    extract_message_data,
+    handle_escalation_node,
+    humanizer_node,
+    process_message,
+    select_trigger_type,
+    should_continue_after_data,
+    should_continue_after_extract,
+    should_escalate,
+)
+from src.integrations import _render_notion_page, log_message_to_db, send_whatsapp_message
+from src.prompts import HISTORY_LIMIT, format_history, get_system_prompt, get_user_prompt
+from src.tools import CLUB_IDS_BY_NAME, CLUB_NAMES, _resolve_club_id, get_schedule_by_club
+
+
+# HTTP client for tests that only need a successful response; MockTransport never hits the network
+_OK_CLIENT = httpx.AsyncClient(
+    base_url="https://test",
+    transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})),
+)
+
+
+@pytest.fixture
+def patch_httpx(monkeypatch):
+    """Route every integrations request through the mock transport."""
+    monkeypatch.setattr("src.integrations._get_client", lambda name: _OK_CLIENT)
+
+
+# Initial graph state shared by state tests; copy before use
+_STATE_TEMPLATE: FermerState = {
+    "chat_id": "77001234567",
+    "sender_id": "77001234567",
+    "message": "Привет!",
+    "source": "whatsapp",
+    "channel_id": "test-channel",
+    "timestamp": "2025-01-15T10:00:00",
+    "messages": [],
+    "history_text": "",
+    "triggers": {},
+    "should_respond": True,
+}
 
 
 class TestStateFlow:
@@ -25,47 +73,86 @@ class TestStateFlow:
     
     def test_initial_state_creation(self):
         """Test that initial state is created correctly."""
-        from src.graph import FermerState
-        
-        state: FermerState = {
-            "chat_id": "77001234567",
-            "sender_id": "77001234567",
-            "message": "Привет!",
-            "source": "whatsapp",
-            "channel_id": "test-channel",
-            "timestamp": "2025-01-15T10:00:00",
-            "messages": [],
-            "messages_history": [],
-            "triggers": {},
-            "should_respond": True,
-        }
+        state: FermerState = _STATE_TEMPLATE.copy()
         
         assert state["chat_id"] == "77001234567"
         assert state["should_respond"] is True
     
-    def test_trigger_selection(self):
+    @pytest.mark.parametrize("triggers,expected", [
+        ({"firstTraining": True}, "first_training"),
+        ({"noActivity": True, "firstTraining": False}, "no_activity"),
+        ({"payment": True}, "payment"),
+        ({}, "default"),
+    ])
+    def test_trigger_selection(self, triggers, expected):
         """Test trigger type selection logic."""
-        from src.graph import select_trigger_type
+        assert select_trigger_type({"triggers": triggers})["trigger_type"] == expected
+    
+    def test_trigger_priority_is_immutable(self):
+        """Test that the trigger priority table is a tuple of (flag, trigger_type) pairs."""
+        assert isinstance(TRIGGER_PRIORITY, tuple)
+        assert [trigger for _, trigger in TRIGGER_PRIORITY][0] == "first_training"
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_humanizer_skips_short_response(self):
+        """Test that short responses bypass the humanizer LLM."""
+        result = await humanizer_node({"response_text": "Да, конечно!"})
+        assert result["humanized_response"] == "Да, конечно!"
+    
+    def test_parse_agent_output(self):
+        """Test parsing of the agent JSON output."""
+        # Markdown-wrapped JSON
+        parsed = _parse_agent_output(
+            '```json\n{"response": "Привет!", "escalation": {"needed": true, "reason": "pain"}}\n```'
+        )
+        assert parsed.response_text == "Привет!"
+        assert parsed.escalation.needed is True
+        assert parsed.escalation.reason == "pain"
         
-        # Test first training trigger
-        state = {"triggers": {"firstTraining": True}}
-        result = select_trigger_type(state)
-        assert result["trigger_type"] == "first_training"
+        # Null or non-dict escalation keeps the response
+        for content in ('{"response": "Привет", "escalation": null}',
+                        '{"response": "Привет", "escalation": "no"}',
+                        '{"response": "Привет", "escalation": {"needed": null}}'):
+            parsed = _parse_agent_output(content)
+            assert parsed.response_text == "Привет"
+            assert parsed.escalation.needed is False
         
-        # Test no activity trigger
-        state = {"triggers": {"noActivity": True, "firstTraining": False}}
-        result = select_trigger_type(state)
-        assert result["trigger_type"] == "no_activity"
+        # Non-string reason is kept as text
+        for content, reason in (('{"response": "hi", "escalation": {"needed": true, "reason": 5}}', "5"),
+                                ('{"response": "hi", "escalation": {"needed": true, "reason": ["a"]}}', "['a']")):
+            parsed = _parse_agent_output(content)
+            assert parsed.response_text == "hi"
+            assert parsed.escalation.needed is True
+            assert parsed.escalation.reason == reason
         
-        # Test payment trigger
-        state = {"triggers": {"payment": True}}
-        result = select_trigger_type(state)
-        assert result["trigger_type"] == "payment"
+        # Valid JSON with an unparseable field still yields the reply and escalation
+        parsed = _parse_agent_output('{"response": "hi", "escalation": {"needed": {"x": 1}, "reason": "pain"}}')
+        assert parsed.response_text == "hi"
+        assert parsed.escalation.needed is True
+        assert parsed.escalation.reason == "pain"
         
-        # Test default trigger
-        state = {"triggers": {}}
-        result = select_trigger_type(state)
-        assert result["trigger_type"] == "default"
+        # Plain text
+        parsed = _parse_agent_output("Просто текст")
+        assert parsed.response_text is None
+        assert parsed.escalation.needed is False
+    
+    def test_trim_agent_messages(self):
+        """Test that the ReAct context keeps the prompt and valid tool pairs."""
+        messages = [SystemMessage(content="sys"), HumanMessage(content="hi")]
+        for i in range(10):
+            messages.append(AIMessage(content="", tool_calls=[
+                {"name": "get_general_info", "args": {}, "id": f"call_{i}"},
+            ]))
+            messages.append(ToolMessage(content="x" * 3000, tool_call_id=f"call_{i}"))
+        
+        trimmed = _trim_agent_messages(messages)
+        
+        assert len(trimmed) <= MAX_AGENT_MESSAGES
+        assert [m.content for m in trimmed[:2]] == ["sys", "hi"]
+        assert isinstance(trimmed[2], AIMessage)
+        # Latest tool output is intact, earlier ones are truncated
+        assert len(trimmed[-1].content) == 3000
+        assert len(trimmed[-3].content) < TOOL_OUTPUT_TRIM_LENGTH + 20
 
 
 class TestPrompts:
@@ -73,149 +160,570 @@ class TestPrompts:
     
     def test_system_prompt_first_training(self):
         """Test system prompt for first training scenario."""
-        from src.prompts import get_system_prompt
-        
-        prompt = get_system_prompt(
-            trigger_type="first_training",
-            user_data={"firstName": "Тест"},
-            user_profile={},
-        )
+        prompt = get_system_prompt(trigger_type="first_training")
         
         assert "Batyr" in prompt
         assert "first training" in prompt.lower() or "workout" in prompt.lower()
         assert "JSON" in prompt
     
+    def test_system_prompt_is_static(self):
+        """Test that the system prompt is identical across calls (provider cacheable)."""
+        first = get_system_prompt(trigger_type="payment")
+        second = get_system_prompt(trigger_type="payment")
+        
+        assert first is second
+        assert "<current_date>" not in first
+    
     def test_user_prompt_includes_message(self):
         """Test that user prompt includes the message."""
-        from src.prompts import get_user_prompt
-        
         prompt = get_user_prompt(
             trigger_type="default",
             message="Как записаться на тренировку?",
-            messages_history=[],
+            history_text="",
             training_data={},
             user_data={},
         )
         
         assert "Как записаться на тренировку?" in prompt
+    
+    def test_user_prompt_formats_history(self):
+        """Test that the dialog is rendered into the history block."""
+        dialog = [{"sender": "user", "created_at": "2025-01-15T10:00:00", "text": "Привет!"}]
+        history_text = format_history([{"text": "old"}] * HISTORY_LIMIT + dialog)
+        assert "old" in history_text and history_text.count("\n") == HISTORY_LIMIT - 1
+        
+        prompt = get_user_prompt(
+            trigger_type="default",
+            message="И ещё вопрос",
+            history_text=history_text,
+            training_data={},
+            user_data={},
+        )
+        
+        assert "user (2025-01-15T10:00:00): Привет!" in prompt
 
 
 class TestTools:
     """Test tool functions."""
     
-    @pytest.mark.asyncio
+    @pytest.mark.asyncio(loop_scope="session")
     async def test_schedule_tool_validates_club(self):
         """Test that schedule tool validates club ID."""
-        from src.tools import get_schedule_by_club
-        
         # Invalid club ID should return error message
         result = await get_schedule_by_club.ainvoke({
             "club_id": "invalid-club",
         })
         
         assert "❌" in result or "Укажите клуб" in result
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_schedule_is_cached_per_week(self):
+        """Test that filter changes reuse the fetched week and drop finished/test events."""
+        start = (datetime.utcnow() + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        mock_response = MagicMock()
+        mock_response.content = orjson.dumps({"data": {"eventsByDates": [
+            {"id": "e1", "startTime": start, "status": "planned", "programSet": {"name": "RT Upper"}},
+            {"id": "e2", "startTime": start, "status": "finished", "programSet": {"name": "Bootcamp"}},
+            {"id": "e3", "startTime": start, "status": "planned", "programSet": {"name": "[TEST] RT"}},
+        ]}})
+
+        tools._schedule_cache.clear()
+        with patch("src.tools.request", AsyncMock(return_value=mock_response)) as mock_request:
+            week = await tools.get_schedule_by_club.ainvoke({"club_id": "Colibri"})
+            strength = await tools.get_schedule_by_club.ainvoke({
+                "club_id": "Colibri", "training_type": "strength",
+            })
+
+            assert mock_request.await_count == 1
+            assert "[id:e1]" in week and "[id:e1]" in strength
+            assert "[id:e2]" not in week and "[id:e3]" not in week
+        tools._schedule_cache.clear()
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_schedule_fetches_only_requested_day(self):
+        """Test that period/day_of_week narrow the fetched range to one day."""
+        mock_response = MagicMock()
+        mock_response.content = orjson.dumps({"data": {"eventsByDates": []}})
+
+        tools._schedule_cache.clear()
+        with patch("src.tools.request", AsyncMock(return_value=mock_response)) as mock_request:
+            await tools.get_schedule_by_club.ainvoke({"club_id": "Colibri", "period": "tomorrow"})
+            await tools.get_schedule_by_club.ainvoke({"club_id": "Colibri", "day_of_week": "friday"})
+
+            for call in mock_request.await_args_list:
+                variables = orjson.loads(call.kwargs["content"])["variables"]
+                start = datetime.fromisoformat(variables["startTime"][:19])
+                end = datetime.fromisoformat(variables["endTime"][:19])
+                assert end - start == timedelta(days=1, seconds=-1)
+        tools._schedule_cache.clear()
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_knowledge_base_results_are_cached(self):
+        """Test that repeated queries reuse the embedding and the formatted result."""
+        match = MagicMock(score=0.9, metadata={"text": "Hero's Pass", "source": "kb"})
+        mock_index = MagicMock()
+        mock_index.query.return_value = MagicMock(matches=[match])
+        mock_embeddings = MagicMock()
+        mock_embeddings.aembed_query = AsyncMock(return_value=[0.1, 0.2])
+
+        tools._clear_kb_cache()
+        with patch("src.tools._get_pinecone_index", return_value=mock_index), \
+             patch("src.tools._get_embeddings", return_value=mock_embeddings):
+            first = await tools.search_knowledge_base.ainvoke({"query": "Сколько стоит"})
+            second = await tools.search_knowledge_base.ainvoke({"query": "  сколько   стоит "})
+
+            assert first == second
+            assert "Hero's Pass" in first
+            assert mock_embeddings.aembed_query.await_count == 1
+            assert mock_index.query.call_count == 1
+        tools._clear_kb_cache()
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_knowledge_base_reuses_similar_query_result(self):
+        """Test that a near-identical query embedding skips the Pinecone search."""
+        match = MagicMock(score=0.9, metadata={"text": "Рассрочка 0-0-12", "source": "kb"})
+        mock_index = MagicMock()
+        mock_index.query.return_value = MagicMock(matches=[match])
+        mock_embeddings = MagicMock()
+        mock_embeddings.aembed_query = AsyncMock(side_effect=[[1.0, 0.0], [0.999, 0.04], [0.0, 1.0]])
+
+        tools._clear_kb_cache()
+        with patch("src.tools._get_pinecone_index", return_value=mock_index), \
+             patch("src.tools._get_embeddings", return_value=mock_embeddings):
+            first = await tools.search_knowledge_base.ainvoke({"query": "есть рассрочка?"})
+            similar = await tools.search_knowledge_base.ainvoke({"query": "а рассрочка есть"})
+            assert similar == first
+            assert mock_index.query.call_count == 1
+
+            await tools.search_knowledge_base.ainvoke({"query": "где клуб"})
+            assert mock_index.query.call_count == 2
+        tools._clear_kb_cache()
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_google_doc_fetches_are_coalesced(self):
+        """Test that concurrent reads of one doc share a single download."""
+        async def slow_get(*args, **kwargs):
+            await asyncio.sleep(0.01)
+            return MagicMock(status_code=200, text="Правила студии")
+
+        tools._docs_cache.invalidate("doc")
+        with patch("src.tools._get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(side_effect=slow_get)
+
+            results = await asyncio.gather(*(tools._fetch_google_doc("doc") for _ in range(3)))
+
+            assert results == ["Правила студии"] * 3
+            assert mock_client.return_value.get.await_count == 1
+        tools._docs_cache.invalidate("doc")
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_docs_bundle_fetches_each_topic_once(self):
+        """Test that the bundle tool returns every requested doc under its topic."""
+        fetch = AsyncMock(side_effect=lambda doc_id: f"text of {doc_id}")
+        with patch("src.tools._fetch_google_doc", fetch):
+            result = await tools.get_docs_bundle.ainvoke({
+                "topics": ["membership_info", "workout_info", "membership_info"],
+            })
+
+        assert fetch.await_count == 2
+        assert result.index("=== membership_info ===") < result.index("=== workout_info ===")
+        assert f"text of {tools.GOOGLE_DOCS['workout_info']}" in result
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_profile_update_flushes_cached_fermer_data(self):
+        """Test that only a successful profile write drops the cached fermer read."""
+        ok = {"data": {"updateFermerProfile": {"success": True}}}
+        
+        with patch("src.tools._backend_post", AsyncMock(side_effect=[ok, {"data": {}}])), \
+             patch("src.tools.invalidate_cached") as mock_invalidate:
+            args = {"chat_id": "77001234567", "field": "goal", "value": "похудеть"}
+            assert (await tools.update_user_profile.ainvoke(args)).startswith("✅")
+            await tools.update_user_profile.ainvoke(args)
+        
+        mock_invalidate.assert_called_once_with("77001234567")
     
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_image_is_inlined_as_data_url(self):
+        """Test that images are downloaded once and sent to the model inline."""
+        requests = []
+        
+        def handler(request):
+            requests.append(request.url.path)
+            if request.url.path == "/flaky.jpg" and requests.count("/flaky.jpg") == 1:
+                return httpx.Response(503)
+            if request.url.path in ("/a.jpg", "/flaky.jpg"):
+                return httpx.Response(200, content=b"\xff\xd8jpeg", headers={"content-type": "image/jpeg"})
+            if request.url.path == "/page":
+                return httpx.Response(200, content=b"<html>", headers={"content-type": "text/html"})
+            if request.url.path == "/huge.jpg":
+                return httpx.Response(200, content=b"x" * (tools.IMAGE_INLINE_MAX_BYTES + 1),
+                                      headers={"content-type": "image/jpeg"})
+            raise httpx.ConnectError("down")
+        
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        urls = [f"https://store.wazzup24.com/{name}" for name in ("a.jpg", "b.jpg", "page", "huge.jpg", "flaky.jpg")]
+        for url in urls:
+            tools._image_cache.invalidate(url)
+        with patch("src.tools._get_http_client", return_value=client), \
+             patch("src.tools.random.uniform", return_value=0):
+            first = await tools._image_data_url(urls[0])
+            second = await tools._image_data_url(urls[0])
+            assert first == second == "data:image/jpeg;base64,/9hqcGVn"
+            assert requests == ["/a.jpg"]
+            
+            # A transient 503 is retried
+            assert await tools._image_data_url(urls[4]) == "data:image/jpeg;base64,/9hqcGVn"
+            assert requests.count("/flaky.jpg") == 2
+            
+            # Download failures (after retries), non-images and oversized images fall back to the URL
+            for url in urls[1:4]:
+                assert await tools._image_data_url(url) == url
+            assert requests.count("/b.jpg") == tools.RETRY_ATTEMPTS
+            
+            # Untrusted hosts and plain http are never fetched by the server
+            for url in ("https://169.254.169.254/latest/meta-data", "http://store.wazzup24.com/a.jpg",
+                        "https://wazzup24.com.evil.example/a.jpg", "https://localhost/a.jpg"):
+                assert await tools._image_data_url(url) == url
+            assert len(requests) == 5 + tools.RETRY_ATTEMPTS
+        for url in urls:
+            tools._image_cache.invalidate(url)
+
     def test_club_name_mapping(self):
         """Test club name to ID mapping."""
-        from src.tools import CLUB_NAMES, CLUB_IDS_BY_NAME
-        
+        assert CLUB_IDS_BY_NAME["colibri"] == CLUB_IDS_BY_NAME["колибри"] == "65e9e70cbd4814536c5e27e9"
         assert CLUB_NAMES["65e9e70cbd4814536c5e27e9"] == "Colibri"
-        assert CLUB_IDS_BY_NAME["colibri"] == "65e9e70cbd4814536c5e27e9"
-        assert CLUB_IDS_BY_NAME["колибри"] == "65e9e70cbd4814536c5e27e9"
+        assert isinstance(CLUB_NAMES, MappingProxyType)
+        assert all(k == k.casefold() for k in CLUB_IDS_BY_NAME)
+    
+    def test_club_lookup_normalizes_input(self):
+        """Test that club names resolve regardless of case, spaces and punctuation."""
+        assert _resolve_club_id("COLIBRI ") == "65e9e70cbd4814536c5e27e9"
+        assert _resolve_club_id("Променад.") == "67d7c4cc8b5b3112cb0bcd44"
+        assert _resolve_club_id("Europe-City") == "6788b54527af6c00ab78c66a"
+        assert _resolve_club_id("нурлы  орда") == "6351ace4d61faf000b2febc8"
+        assert _resolve_club_id("расписание на завтра в Променаде") == "67d7c4cc8b5b3112cb0bcd44"
+        assert _resolve_club_id("65e9e70cbd4814536c5e27e9") == "65e9e70cbd4814536c5e27e9"
+        assert _resolve_club_id("unknown") == "unknown"
 
 
 class TestIntegrations:
     """Test external integrations."""
     
-    @pytest.mark.asyncio
-    async def test_send_whatsapp_message_format(self):
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_send_whatsapp_message_format(self, patch_httpx):
         """Test WhatsApp message sending format."""
-        from src.integrations import send_whatsapp_message
+        result = await send_whatsapp_message(
+            chat_id="77001234567",
+            channel_id="test-channel",
+            text="Test message",
+        )
+        
+        assert result is True
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_fetch_fermer_data_is_cached(self):
+        """Test that repeated reads hit the cache until a write invalidates it."""
+        mock_response = AsyncMock()
+        mock_response.status_code = 200
+        mock_response.content = b'{"data": {"fermerByChatId": {"id": "f1"}}}'
         
-        with patch("src.integrations.httpx.AsyncClient") as mock_client:
-            mock_response = AsyncMock()
-            mock_response.status_code = 200
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(
-                return_value=mock_response
+        with patch("src.integrations._get_client") as mock_client:
+            mock_client.return_value.request = AsyncMock(return_value=mock_response)
+            integrations.invalidate_cached("77001234567")
+            
+            first = await integrations.fetch_fermer_data("77001234567")
+            second = await integrations.fetch_fermer_data("77001234567")
+            assert first == second == {"id": "f1"}
+            assert mock_client.return_value.request.await_count == 1
+            
+            integrations.invalidate_cached("77001234567")
+            await integrations.fetch_fermer_data("77001234567")
+            assert mock_client.return_value.request.await_count == 2
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_ttl_cache_is_bounded(self):
+        """Test that live entries past max_size evict the least recently used."""
+        cache = integrations.TTLCache(ttl=60, max_size=2)
+        
+        async def fetch():
+            return "fresh"
+        
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert await cache.get_or_fetch("a", fetch) == 1
+        cache.set("c", 3)
+        await cache.get_or_fetch("d", fetch)
+        
+        assert list(cache._entries) == ["c", "d"]
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_log_messages_are_batched(self):
+        """Test that concurrent DB log calls share one GraphQL request."""
+        mock_response = AsyncMock()
+        mock_response.status_code = 200
+        mock_response.content = orjson.dumps({
+            "data": {"m0": {"id": "1"}, "m1": None},
+            "errors": [{"message": "failed", "path": ["m1"]}],
+        })
+        
+        with patch("src.integrations._get_client") as mock_client:
+            mock_client.return_value.request = AsyncMock(return_value=mock_response)
+            
+            results = await asyncio.gather(
+                log_message_to_db("q1", "77001234567", "u1", 'Say "hi"\n', "ai"),
+                log_message_to_db("q1", "77001234567", "u1", "Second", "ai"),
             )
             
-            result = await send_whatsapp_message(
-                chat_id="77001234567",
-                channel_id="test-channel",
-                text="Test message",
+            assert results == [True, False]
+            mock_client.return_value.request.assert_awaited_once()
+            payload = orjson.loads(mock_client.return_value.request.call_args.kwargs["content"])
+            assert "m0: addFermerMessage" in payload["query"]
+            assert "m1: addFermerMessage" in payload["query"]
+            assert payload["variables"]["text0"] == 'Say "hi"\n'
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_log_batch_isolates_invalid_entries(self):
+        """Test that one bad entry doesn't lose the other messages of its batch."""
+        def reply(content):
+            response = MagicMock(status_code=200)
+            response.content = orjson.dumps(content)
+            return response
+        
+        rejected = reply({"errors": [{"message": "Variable $queryId1 of non-null type ID! must not be null"}]})
+        
+        with patch("src.integrations._get_client") as mock_client:
+            mock_client.return_value.request = AsyncMock(side_effect=[
+                rejected,
+                reply({"data": {"m0": {"id": "1"}}}),
+                reply({"data": {"m0": {"id": "2"}}}),
+            ])
+            
+            # An entry without a query id is never sent
+            assert await log_message_to_db(None, "77001234567", "u1", "No query yet", "user") is False
+            assert mock_client.return_value.request.await_count == 0
+            
+            # A whole-document rejection falls back to one request per entry
+            results = await asyncio.gather(
+                log_message_to_db("q1", "77001234568", "u2", "First", "ai"),
+                log_message_to_db("q2", "77001234569", "u3", "Second", "ai"),
             )
+            assert results == [True, True]
+            assert mock_client.return_value.request.await_count == 3
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_request_retries_and_opens_breaker(self):
+        """Test retries on 5xx and fail-fast once the circuit is open."""
+        failing = AsyncMock()
+        failing.status_code = 503
+        
+        with patch("src.integrations._get_client") as mock_client, \
+             patch("src.integrations.asyncio.sleep", AsyncMock()), \
+             patch.dict(integrations._breakers, {"amocrm": integrations._CircuitBreaker()}):
+            mock_client.return_value.request = AsyncMock(return_value=failing)
+            
+            response = await integrations.request("amocrm", "GET", "/leads")
+            assert response.status_code == 503
+            assert mock_client.return_value.request.await_count == integrations.RETRY_ATTEMPTS
+            
+            for _ in range(integrations.BREAKER_FAILURE_THRESHOLD - 1):
+                await integrations.request("amocrm", "GET", "/leads")
+            
+            with pytest.raises(integrations.CircuitOpenError):
+                await integrations.request("amocrm", "GET", "/leads")
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_breaker_recovers_after_interrupted_trial(self):
+        """Test that a cancelled or crashed half-open trial doesn't keep the circuit open."""
+        ok = MagicMock(status_code=200)
+        breaker = integrations._CircuitBreaker()
+        breaker.failures = integrations.BREAKER_FAILURE_THRESHOLD
+        breaker.opened_at = time.monotonic() - integrations.BREAKER_RECOVERY_TIME
+        
+        with patch("src.integrations._get_client") as mock_client, \
+             patch.dict(integrations._breakers, {"amocrm": breaker}):
+            mock_client.return_value.request = AsyncMock(side_effect=asyncio.CancelledError)
+            with pytest.raises(asyncio.CancelledError):
+                await integrations.request("amocrm", "GET", "/leads")
+            assert not breaker.trial_in_flight
+            
+            mock_client.return_value.request = AsyncMock(side_effect=httpx.InvalidURL("bad"))
+            with pytest.raises(httpx.InvalidURL):
+                await integrations.request("amocrm", "GET", "/leads")
+            assert not breaker.trial_in_flight
             
-            assert result is True
+            # The next trial goes through and its success closes the circuit
+            mock_client.return_value.request = AsyncMock(return_value=ok)
+            response = await integrations.request("amocrm", "GET", "/leads")
+            assert response is ok
+            assert breaker.opened_at is None
+            assert breaker.failures == 0
+    
+    def test_notion_page_template(self):
+        """Test that the Notion payload template yields valid, escaped JSON."""
+        page = orjson.loads(_render_notion_page(
+            title="Escalation: Тест (77001234567)",
+            chat_id="77001234567",
+            reason='Says "@club@"',
+            club="Colibri",
+            created="2025-01-15T10:00:00",
+            last_message="Болит колено\n",
+            ai_response="Передаю менеджеру",
+        ))
+        
+        assert page["properties"]["Reason"]["rich_text"][0]["text"]["content"] == 'Says "@club@"'
+        assert page["properties"]["Club"]["rich_text"][0]["text"]["content"] == "Colibri"
+        assert page["children"][1]["paragraph"]["rich_text"][0]["text"]["content"] == "Болит колено\n"
 
 
 class TestConditionalEdges:
     """Test conditional edge functions."""
     
-    def test_should_continue_after_data(self):
-        """Test data validation conditional."""
-        from src.graph import should_continue_after_data
-        
-        # With error
-        state = {"error": "Some error", "should_respond": True}
-        assert should_continue_after_data(state) == "end"
+    def test_should_continue_after_extract(self):
+        """Test that non-conversational messages end the run early."""
+        for message, source in [("", "whatsapp"), ("👍", "whatsapp"), ("Ok", "whatsapp"),
+                                ("...", "whatsapp"), ("Привет!", "email")]:
+            state = {"message": message, "source": source}
+            state.update(extract_message_data(state))
+            assert should_continue_after_extract(state) == "end"
         
-        # Without error
-        state = {"error": None, "should_respond": True}
-        assert should_continue_after_data(state) == "select_trigger"
-        
-        # Should not respond
-        state = {"error": None, "should_respond": False}
-        assert should_continue_after_data(state) == "end"
+        state = {"message": "Привет!", "source": "whatsapp"}
+        state.update(extract_message_data(state))
+        assert should_continue_after_extract(state) == "fetch_fermer_data"
+    
+    @pytest.mark.parametrize("error,should_respond,expected", [
+        ("Some error", True, "end"),
+        (None, True, "select_trigger"),
+        (None, False, "end"),
+    ], ids=["error", "ok", "no_respond"])
+    def test_should_continue_after_data(self, error, should_respond, expected):
+        """Test data validation conditional."""
+        state = {"error": error, "should_respond": should_respond}
+        assert should_continue_after_data(state) == expected
     
-    def test_should_escalate(self):
+    @pytest.mark.parametrize("needed,expected", [(True, "escalate"), (False, "end")],
+                             ids=["needed", "not_needed"])
+    def test_should_escalate(self, needed, expected):
         """Test escalation conditional."""
-        from src.graph import should_escalate
-        
-        # Escalation needed
-        state = {"escalation_needed": True}
-        assert should_escalate(state) == "escalate"
-        
-        # No escalation
-        state = {"escalation_needed": False}
-        assert should_escalate(state) == "end"
+        assert should_escalate({"escalation_needed": needed}) == expected
+
+
+class TestEscalation:
+    """Test escalation side-effects."""
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_escalation_collects_errors(self):
+        """Test that one failing action doesn't skip the others."""
+        with patch("src.graph.notify_telegram", AsyncMock(return_value=True)) as mock_tg, \
+             patch("src.graph.create_notion_escalation", AsyncMock(return_value=True)) as mock_notion, \
+             patch("src.graph.update_amocrm_lead", AsyncMock(side_effect=RuntimeError("boom"))):
+
+            result = await handle_escalation_node({
+                "escalation_needed": True,
+                "escalation_reason": "pain",
+                "sender_id": "77001234567",
+                "message": "Болит колено",
+                "response_text": "Передаю менеджеру",
+                "user_data": {"firstName": "Тест"},
+            })
+
+            # Notion runs as a background task
+            await asyncio.sleep(0)
+            
+            mock_tg.assert_awaited_once()
+            mock_notion.assert_awaited_once()
+            assert "AmoCRM: boom" in result["error"]
+
+
+# Node results for the mocked end-to-end flow (read-only, shared across runs)
+_FERMER_RET = MappingProxyType({
+    "user_id": "test-user",
+    "triggers": {"firstTraining": True},
+    "user_data": {"firstName": "Тест"},
+    "history_text": "",
+})
+_AI_RET = MappingProxyType({
+    "response_text": "Поздравляю с первой тренировкой!",
+    "escalation_needed": False,
+    "escalation_reason": "",
+})
+_HUMANIZER_RET = MappingProxyType({
+    "humanized_response": "Поздравляю с первой тренировкой! 💪",
+})
+
+
+def _aret(value):
+    """Graph node stub returning a fresh copy of value (LangGraph wants a dict)."""
+    async def _node(*args, **kwargs):
+        return dict(value)
+    return _node
+
+
+@pytest.fixture
+def graph_mocks(monkeypatch):
+    """Graph nodes replaced by stubs returning the canned results above."""
+    stubs = {
+        "fetch_fermer_data_node": _aret(_FERMER_RET),
+        "ai_agent_node": _aret(_AI_RET),
+        "humanizer_node": _aret(_HUMANIZER_RET),
+        "send_response_node": _aret({}),
+    }
+    for name, stub in stubs.items():
+        monkeypatch.setattr(f"src.graph.{name}", stub)
+    # The compiled graph holds the node functions, so rebuild it around the stubs
+    monkeypatch.setattr("src.graph.fermer_graph", create_fermer_graph())
+    return stubs
 
 
 class TestEndToEnd:
     """End-to-end tests (mocked)."""
     
-    @pytest.mark.asyncio
-    async def test_full_flow_mock(self):
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_full_flow_mock(self, graph_mocks):
         """Test full message processing flow with mocks."""
-        from src.graph import process_message
+        result = await process_message(
+            chat_id="77001234567",
+            sender_id="77001234567",
+            message="Привет!",
+            source="whatsapp",
+            channel_id="test-channel",
+        )
         
-        with patch("src.graph.fetch_fermer_data_node") as mock_fermer, \
-             patch("src.graph.ai_agent_node") as mock_ai, \
-             patch("src.graph.humanizer_node") as mock_humanizer, \
-             patch("src.graph.send_response_node") as mock_send:
-            
-            # Setup mocks
-            mock_fermer.return_value = {
-                "user_id": "test-user",
-                "triggers": {"firstTraining": True},
-                "user_data": {"firstName": "Тест"},
-                "messages_history": [],
-            }
-            
-            mock_ai.return_value = {
-                "response_text": "Поздравляю с первой тренировкой!",
-                "escalation_needed": False,
-                "escalation_reason": "",
-            }
-            
-            mock_humanizer.return_value = {
-                "humanized_response": "Поздравляю с первой тренировкой! 💪",
-            }
-            
-            mock_send.return_value = {}
-            
-            # This would run the full flow in a real scenario
-            # For now, just verify the test structure is correct
-            assert True
+        assert result["response_text"] == _HUMANIZER_RET["humanized_response"]
+        assert result["escalation_needed"] is False
+        assert result["error"] is None
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_repeated_message_reloads_fermer_data(self, graph_mocks, monkeypatch):
+        """Test that sending the same short message twice sees fresh history."""
+        fetches = []
+        
+        async def fetch(state):
+            fetches.append(state["message"])
+            return {**_FERMER_RET, "history_text": f"turn {len(fetches)}"}
+        
+        monkeypatch.setattr("src.graph.fetch_fermer_data_node", fetch)
+        monkeypatch.setattr("src.graph.fermer_graph", create_fermer_graph())
+        for _ in range(2):
+            await process_message(chat_id="77001234567", sender_id="77001234567", message="да")
+        
+        assert fetches == ["да", "да"]
+    
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_each_turn_appends_a_fresh_prompt(self, graph_mocks, monkeypatch):
+        """Test that a repeated question still reaches the agent as a new prompt."""
+        last_messages = []
+        
+        async def agent(state):
+            last_messages.append(state["messages"][-1])
+            return {**_AI_RET, "messages": [AIMessage(content="ok")]}
+        
+        monkeypatch.setattr("src.graph.ai_agent_node", agent)
+        monkeypatch.setattr("src.graph.fermer_graph", create_fermer_graph())
+        for message in ("Привет", "Другое", "Привет"):
+            await process_message(chat_id="77000000042", sender_id="77000000042", message=message)
+        
+        assert all(isinstance(m, HumanMessage) for m in last_messages)
+        assert len({m.id for m in last_messages}) == 3
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+"""
+Fermer Agent Server Tests
+=========================
+Webhook handling: background processing, per-chat ordering and dedupe.
+"""
+
+import pytest
+import asyncio
+import httpx
+
+from src import server
+
+
+@pytest.fixture
+def agent_calls(monkeypatch):
+    """process_message replaced by a stub that records start/end of each run."""
+    calls = []
+
+    async def process_message(chat_id, message, **kwargs):
+        calls.append(("start", chat_id, message))
+        await asyncio.sleep(0.01)
+        calls.append(("end", chat_id, message))
+        return {"response_text": f"re: {message}", "escalation_needed": False}
+
+    monkeypatch.setattr(server, "process_message", process_message)
+    return calls
+
+
+class TestInFlight:
+    """Test process_message_once coalescing and ordering."""
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_messages_of_one_chat_run_in_order(self, agent_calls):
+        """Test that different messages of one chat never overlap."""
+        results = await asyncio.gather(
+            server.process_message_once("77001234567", "Привет", sender_id="77001234567"),
+            server.process_message_once("77001234567", "Сколько стоит?", sender_id="77001234567"),
+        )
+
+        assert [r["response_text"] for r in results] == ["re: Привет", "re: Сколько стоит?"]
+        assert agent_calls == [
+            ("start", "77001234567", "Привет"),
+            ("end", "77001234567", "Привет"),
+            ("start", "77001234567", "Сколько стоит?"),
+            ("end", "77001234567", "Сколько стоит?"),
+        ]
+        assert not server._chat_locks and not server._inflight
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_identical_inflight_messages_run_once(self, agent_calls):
+        """Test that a duplicate webhook awaits the run already in flight."""
+        first, second = await asyncio.gather(
+            server.process_message_once("77001234567", "Привет", sender_id="77001234567"),
+            server.process_message_once("77001234567", "Привет", sender_id="77001234567"),
+        )
+
+        assert first is second
+        assert len(agent_calls) == 2  # one start, one end
+
+
+class TestWazzupWebhook:
+    """Test the Wazzup webhook endpoint."""
+
+    @staticmethod
+    def _client():
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_webhook_acks_with_empty_response(self, agent_calls):
+        """Test that the webhook ACKs with an empty reply and processes in the background."""
+        async with self._client() as client:
+            response = await client.post("/webhook/wazzup", json={"messages": [
+                {"chatId": "77001234567", "channelId": "c", "text": "Привет"},
+                {"chatId": "77001234567", "channelId": "c", "text": "Ещё вопрос"},
+                {"chatId": "77001234567", "channelId": "c", "text": "echo", "status": "outbound"},
+            ]})
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "response_text": "",
+            "escalation_needed": False,
+            "escalation_reason": "",
+            "error": None,
+        }
+        # Background tasks have finished once the ASGI call returns
+        assert [call for call in agent_calls if call[0] == "start"] == [
+            ("start", "77001234567", "Привет"),
+            ("start", "77001234567", "Ещё вопрос"),
+        ]
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_webhook_skips_non_inbound(self, agent_calls):
+        """Test that delivery receipts and echoes are acknowledged but not processed."""
+        async with self._client() as client:
+            response = await client.post("/webhook/wazzup", json={"messages": [
+                {"chatId": "77001234567", "channelId": "c", "text": "echo", "status": "outbound"},
+            ]})
+
+        assert response.json()["error"] == "Not an inbound message"
+        assert agent_calls == []
+
+    @pytest.mark.asyncio(loop_scope="session")
+    async def test_webhook_logs_background_failures(self, monkeypatch, caplog):
+        """Test that a failing run is logged, since the ACK can no longer report it."""
+        async def process_message(**kwargs):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(server, "process_message", process_message)
+        async with self._client() as client:
+            response = await client.post("/webhook/wazzup", json={"messages": [
+                {"chatId": "77001234567", "channelId": "c", "text": "Привет"},
+            ]})
+
+        assert response.status_code == 200
+        assert "boom" in caplog.text